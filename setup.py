@@ -86,6 +86,10 @@ setup(
         "matplotlib>=3.0.2,<4.0.0",
         "numpy>=1.15.4,<2.0.0",
     ],
+    extras_require={
+        # the spectral layout falls back to the grid layout without scipy
+        "spectral": ["scipy>=1.1.0,<2.0.0"],
+    },
     tests_require=[
         "pytest>=4.1.0,<5.0.0",
         "pytest-cov>=2.6.1,<3.0.0",
@@ -95,6 +99,7 @@ setup(
         "console_scripts": [
             "undiscord-bot = undiscord.bot.__main__:main",
             "undiscord-server = undiscord.server.__main__:main",
+            "undiscord-benchmark = undiscord.benchmark.__main__:main",
         ],
     },
     cmdclass={"test": PyTest, "lint": Pylint},
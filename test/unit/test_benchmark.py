@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+from copy import deepcopy
+
+import pendulum
+
+from undiscord.benchmark.__main__ import get_parser, main, run_benchmarks, \
+    run_import_benchmarks, get_benchmarks, run_benchmark
+from undiscord.benchmark.synthetic import generate_server_data
+from undiscord.friend_map import FriendMap
+
+
+def test_get_parser():
+    assert isinstance(get_parser(), argparse.ArgumentParser)
+
+
+def test_generate_server_data():
+    server_data = generate_server_data(channels=3, messages_per_channel=50,
+                                       authors=10, mention_rate=1)
+    assert len(server_data["channels"]) == 3
+    for channel in server_data["channels"]:
+        messages = channel["messages"]
+        assert len(messages) == 50
+        assert all(len(message["mentions"]) == 1 for message in messages)
+        # messages are ordered newest first
+        timestamps = [pendulum.parse(message["timestamp"])
+                      for message in messages]
+        assert timestamps == sorted(timestamps, reverse=True)
+    assert generate_server_data(seed=1, channels=1) == \
+        generate_server_data(seed=1, channels=1)
+    assert FriendMap(server_data).get_graph().number_of_nodes() <= 10
+
+
+def test_generate_server_data_burstiness():
+    def count_connections(burstiness):
+        server_data = generate_server_data(channels=1,
+                                           messages_per_channel=500,
+                                           burstiness=burstiness,
+                                           mention_rate=0)
+        return sum(weight for _, _, weight in
+                   FriendMap(server_data).get_graph().edges(data="weight"))
+
+    assert count_connections(0) < count_connections(0.9)
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(["small"], ["FriendMap", "layout:random"],
+                             repeat=2)
+    json.dumps(results)
+    assert [result["benchmark"] for result in results["results"]] == \
+        ["FriendMap", "layout:random"]
+    for result in results["results"]:
+        assert len(result["times"]) == 2
+        assert result["min"] <= result["mean"]
+        assert result["peak_memory"] > 0
+        assert result["messages"] == 1000
+
+
+def test_benchmarks_fresh_data():
+    server_data = generate_server_data(channels=2, messages_per_channel=20)
+    benchmarks = get_benchmarks(server_data,
+                                FriendMap(deepcopy(server_data)))
+    setup, function = benchmarks["get_connections_from_server"]
+    run_benchmark(function, 2, False, setup)
+    # every run parses the timestamps of its own copy of the data
+    assert all("epoch" not in message
+               for channel in setup()["channels"]
+               for message in channel["messages"])
+
+
+def test_main(tmpdir):
+    output_file = tmpdir.join("results.json")
+    assert main(["-o", str(output_file), "-r", "1", "--no-memory",
+                 "-b", "get_connections_from_server"]) == 0
+    results = json.loads(output_file.read())
+    assert [result["scale"] for result in results["results"]] == \
+        ["small", "medium"]
+    assert results["results"][0]["peak_memory"] is None
+
+
+def test_run_import_benchmarks():
+    results = run_import_benchmarks(["import:undiscord-server"], repeat=1)
+    assert [result["module"] for result in results] == \
+        ["undiscord.server.__main__"]
+    assert results[0]["min"] > 0
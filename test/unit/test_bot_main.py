@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 import pytest
+from discord import HTTPException, Forbidden
 
-from undiscord.bot.__main__ import get_parser, main
+import undiscord.bot.__main__
+from undiscord.bot.__main__ import get_parser, main, stream_server, \
+    collect_server, ServerDataCollector
+from undiscord.message_cache import MessageCache
+from undiscord.metrics import METRICS, MESSAGES_SCRAPED, CHANNELS_SKIPPED
 
 
 def test_get_parser():
@@ -14,3 +25,319 @@ def test_get_parser():
 def test_smoke_main():
     with pytest.raises(SystemExit):
         main([])
+
+
+def test_stream_server(monkeypatch):
+    def run_client(token, timeout, messages_number, server_name, add_server,
+                   add_channel, full_messages=True, **kwargs):
+        assert not full_messages
+        loop = asyncio.new_event_loop()
+        for i in range(10):
+            loop.run_until_complete(add_channel({"id": str(i), "messages": []}))
+        loop.close()
+
+    monkeypatch.setattr(undiscord.bot.__main__, "run_client", run_client)
+    channels = stream_server("token", "server")
+    assert [channel["id"] for channel in channels] == \
+        [str(i) for i in range(10)]
+
+
+class FakeClient:
+    """Client serving canned channel histories with an artificial delay"""
+
+    def __init__(self, channels_number=8, messages_number=5, delay=0.02,
+                 rate_limits=0, retry_after=None):
+        self.delay = delay
+        self.rate_limits = rate_limits
+        self.retry_after = retry_after
+        self.active = 0
+        self.max_active = 0
+        self.fetched = 0
+        author = SimpleNamespace(name="user", id="1")
+        server = SimpleNamespace(name="server", id="0")
+        channels = [SimpleNamespace(name="channel {}".format(i), id=str(i))
+                    for i in range(channels_number)]
+        self.history = {
+            channel.id: [
+                SimpleNamespace(
+                    id=str(1000 - j),
+                    author=author, server=server, channel=channel,
+                    content="msg {}".format(j), mentions=[],
+                    timestamp=datetime(2018, 11, 11) - timedelta(seconds=j)
+                )
+                for j in range(messages_number)
+            ]
+            for channel in channels
+        }
+        self.servers = [
+            SimpleNamespace(name="other", id="-1", channels=[]),
+            SimpleNamespace(name=server.name, id=server.id, channels=channels)
+        ]
+
+    async def logs_from(self, channel, limit=100, before=None):
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        try:
+            history = self.history[channel.id]
+            if before is not None:
+                history = history[history.index(before) + 1:]
+            for message in history[:limit]:
+                await asyncio.sleep(self.delay)
+                if self.rate_limits:
+                    self.rate_limits -= 1
+                    headers = {} if self.retry_after is None else \
+                        {"Retry-After": str(self.retry_after)}
+                    raise HTTPException(
+                        SimpleNamespace(status=429, reason="rate limited",
+                                        headers=headers),
+                        "rate limited")
+                self.fetched += 1
+                yield message
+        finally:
+            self.active -= 1
+
+
+class FakeDiscordClient(FakeClient):
+    """FakeClient that logs in and connects like a discord.py Client"""
+
+    instances = []
+
+    def __init__(self, loop=None, **kwargs):
+        super().__init__(channels_number=12, delay=0.002)
+        self.loop = loop
+        # a single thread delivers the collected channels to the consumer
+        loop.set_default_executor(ThreadPoolExecutor(1))
+        self.user = SimpleNamespace(id="2")
+        self.handlers = {}
+        self.instances.append(self)
+
+    def event(self, coroutine):
+        self.handlers[coroutine.__name__] = coroutine
+        return coroutine
+
+    async def login(self, token, bot=True):
+        pass
+
+    async def connect(self):
+        self.loop.create_task(self.handlers["on_ready"]())
+        await asyncio.sleep(60)
+
+    async def logout(self):
+        pass
+
+
+def test_stream_server_slow_consumer(monkeypatch, caplog):
+    monkeypatch.setattr(undiscord.bot.__main__, "Client", FakeDiscordClient)
+    monkeypatch.setattr(FakeDiscordClient, "instances", [])
+    monkeypatch.setattr(undiscord.bot.__main__, "STREAM_QUEUE_SIZE", 1)
+    monkeypatch.setattr(undiscord.bot.__main__, "COMPLETION_GRACE", 0.05)
+    channels = []
+    for channel in stream_server("token", "server", 5, timeout=0.1,
+                                 concurrency=2):
+        # consuming the channels takes longer than the timeout
+        time.sleep(0.05)
+        channels.append(channel)
+        # collected channels wait on the queue and the concurrency bound
+        # rather than piling up
+        fetched_channels = FakeDiscordClient.instances[0].fetched // 5
+        assert fetched_channels <= len(channels) + 1 + 2
+    assert sorted(int(channel["id"]) for channel in channels) == \
+        list(range(12))
+    assert not any(channel["truncated"] for channel in channels)
+    assert all(len(channel["messages"]) == 5 for channel in channels)
+    # the collection was not cut short waiting on the consumer
+    assert not any(record.getMessage().startswith("collection did not")
+                   for record in caplog.records)
+
+
+def run_collect_server(client, concurrency, cache=None, server_name="server",
+                       **kwargs):
+    collector = ServerDataCollector()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    found = loop.run_until_complete(
+        collect_server(client, server_name, 5, collector.add_server,
+                       collector.add_channel, concurrency=concurrency,
+                       cache=cache, **kwargs))
+    loop.close()
+    assert found == (server_name == "server")
+    return collector.server_data
+
+
+@pytest.mark.parametrize("concurrency", [1, 3, 8])
+def test_collect_server(concurrency):
+    client = FakeClient()
+    start = time.monotonic()
+    server_data = run_collect_server(client, concurrency)
+    elapsed = time.monotonic() - start
+    assert server_data["name"] == "server"
+    assert sorted(channel["id"] for channel in server_data["channels"]) == \
+        [str(i) for i in range(8)]
+    assert all(len(channel["messages"]) == 5
+               for channel in server_data["channels"])
+    assert client.max_active == concurrency
+    # each channel takes 5 delays to collect
+    assert elapsed < 5 * client.delay * (8 / concurrency + 1)
+
+
+def test_collect_server_rate_limited(monkeypatch):
+    monkeypatch.setattr(undiscord.bot.__main__, "RETRY_DELAY", 0.01)
+    client = FakeClient(channels_number=1, rate_limits=2)
+    server_data = run_collect_server(client, 1)
+    messages = server_data["channels"][0]["messages"]
+    assert [message["content"] for message in messages] == \
+        ["msg {}".format(i) for i in range(5)]
+
+
+def test_collect_server_retries_exhausted(monkeypatch, tmpdir):
+    monkeypatch.setattr(undiscord.bot.__main__, "RETRY_DELAY", 0.01)
+    cache = MessageCache(str(tmpdir.join("cache.sqlite")))
+    client = FakeClient(channels_number=1)
+    logs_from = client.logs_from
+
+    async def failing_logs_from(channel, **kwargs):
+        # two messages are collected before every request is rate limited
+        async for message in logs_from(channel, **kwargs):
+            if client.fetched > 2:
+                raise HTTPException(
+                    SimpleNamespace(status=429, reason="rate limited"),
+                    "rate limited")
+            yield message
+
+    monkeypatch.setattr(client, "logs_from", failing_logs_from)
+    server_data = run_collect_server(client, 1, cache)
+    # the partial channel is passed on truncated, leaving the cache empty
+    assert server_data["truncated_channels"] == ["0"]
+    assert len(server_data["channels"][0]["messages"]) == 2
+    assert cache.get_messages("0", "0", 5) == []
+
+
+def test_collect_server_retry_after(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        if delay:
+            delays.append(delay)
+
+    monkeypatch.setattr(undiscord.bot.__main__.asyncio, "sleep", sleep)
+    run_collect_server(FakeClient(channels_number=1, delay=0, rate_limits=1,
+                                  retry_after=0.25), 1)
+    run_collect_server(FakeClient(channels_number=1, delay=0, rate_limits=1),
+                       1)
+    assert delays == [0.25, undiscord.bot.__main__.RETRY_DELAY]
+
+
+def test_collect_server_cached_forbidden(tmpdir, monkeypatch):
+    cache = MessageCache(str(tmpdir.join("cache.sqlite")))
+    client = FakeClient(channels_number=1)
+    run_collect_server(client, 1, cache)
+
+    def forbidden_logs_from(channel, **kwargs):
+        raise Forbidden(SimpleNamespace(status=403, reason="forbidden"),
+                        "forbidden")
+
+    # a token that cannot read the channel does not get its cached messages
+    monkeypatch.setattr(client, "logs_from", forbidden_logs_from)
+    channel_data = run_collect_server(client, 1, cache)["channels"][0]
+    assert channel_data["skipped"]
+    assert channel_data["messages"] == []
+
+
+def test_collect_server_cached(tmpdir):
+    cache = MessageCache(str(tmpdir.join("cache.sqlite")))
+    client = FakeClient(channels_number=2)
+    first_server_data = run_collect_server(client, 2, cache)
+    assert client.fetched == 10
+
+    # two new messages are written to the first channel
+    history = client.history["0"]
+    for i in (1, 2):
+        history.insert(0, SimpleNamespace(
+            id=str(1000 + i), author=history[0].author,
+            server=history[0].server, channel=history[0].channel,
+            content="new msg {}".format(i), mentions=[],
+            timestamp=history[0].timestamp + timedelta(seconds=1)
+        ))
+    client.fetched = 0
+    server_data = run_collect_server(client, 2, cache)
+    # only the new messages, and each channel's newest cached message that
+    # stops its fetch, are collected again
+    assert client.fetched == 2 + 2
+    channels = {channel["id"]: channel for channel in server_data["channels"]}
+    assert [message["id"] for message in channels["0"]["messages"]] == \
+        ["1002", "1001", "1000", "999", "998"]
+    first_channels = {channel["id"]: channel
+                      for channel in first_server_data["channels"]}
+    assert [message["content"] for message in channels["1"]["messages"]] == \
+        [message["content"] for message in first_channels["1"]["messages"]]
+
+
+def test_collect_server_not_found():
+    assert run_collect_server(FakeClient(), 1, server_name="missing") == {}
+
+
+def test_collect_server_channel_timeout(tmpdir):
+    cache = MessageCache(str(tmpdir.join("cache.sqlite")))
+    client = FakeClient(channels_number=2, delay=0.05)
+    start = time.monotonic()
+    server_data = run_collect_server(client, 2, cache, channel_timeout=0.12)
+    # channels are passed on truncated rather than waiting out the timeout
+    assert time.monotonic() - start < 0.2
+    assert sorted(server_data["truncated_channels"]) == ["0", "1"]
+    for channel in server_data["channels"]:
+        assert channel["truncated"]
+        assert 0 < len(channel["messages"]) < 5
+    # truncated channels are not cached
+    assert cache.get_messages("0", "0", 5) == []
+
+
+def test_collect_server_deadline():
+    client = FakeClient(channels_number=4, delay=0.05)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    collector = ServerDataCollector()
+    start = time.monotonic()
+    loop.run_until_complete(
+        collect_server(client, "server", 5, collector.add_server,
+                       collector.add_channel, concurrency=2,
+                       deadline=loop.time() + 0.12))
+    loop.close()
+    assert time.monotonic() - start < 0.2
+    # the channels waiting on the semaphore are truncated at the deadline
+    assert len(collector.server_data["channels"]) == 4
+    assert sorted(collector.server_data["truncated_channels"]) == \
+        ["0", "1", "2", "3"]
+
+
+def test_collect_server_metrics(monkeypatch):
+    client = FakeClient(channels_number=2)
+    logs_from = client.logs_from
+
+    def forbidden_logs_from(channel, **kwargs):
+        if channel.id == "1":
+            raise Forbidden(SimpleNamespace(status=403, reason="forbidden"),
+                            "forbidden")
+        return logs_from(channel, **kwargs)
+
+    monkeypatch.setattr(client, "logs_from", forbidden_logs_from)
+    scraped = METRICS.get_value(MESSAGES_SCRAPED) or 0
+    skipped = METRICS.get_value(CHANNELS_SKIPPED, reason="Forbidden") or 0
+    run_collect_server(client, 2)
+    assert METRICS.get_value(MESSAGES_SCRAPED) == scraped + 5
+    assert METRICS.get_value(CHANNELS_SKIPPED, reason="Forbidden") == \
+        skipped + 1
+
+
+def test_collect_server_logging(monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger="undiscord.bot.__main__")
+    run_collect_server(FakeClient(channels_number=2), 2)
+    messages = [record.getMessage() for record in caplog.records]
+    assert not any(message.startswith("sampled message") for message in messages)
+    assert sum(message.startswith("collected channel") and
+               "messages: 5" in message for message in messages) == 2
+
+    caplog.clear()
+    monkeypatch.setattr(undiscord.bot.__main__, "MESSAGE_LOG_SAMPLE", 1.0)
+    run_collect_server(FakeClient(channels_number=2), 2)
+    assert sum(record.getMessage().startswith("sampled message")
+               for record in caplog.records) == 10
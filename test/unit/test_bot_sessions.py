@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from test_bot_main import FakeClient
+from undiscord.bot.sessions import ClientManager
+from undiscord.common import get_token_scope
+from undiscord.metrics import METRICS
+
+
+class FakeSessionClient(FakeClient):
+    """FakeClient that logs in and connects like a Discord client"""
+
+    def __init__(self, is_bot=False, loop=None):
+        super().__init__(channels_number=2, delay=0)
+        self.loop = loop
+        self.user = SimpleNamespace(id="user")
+        self.is_closed = False
+        self._closed = asyncio.Event(loop=loop)
+        self._ready = asyncio.Event(loop=loop)
+
+    async def login(self, token, bot=True):
+        assert not bot
+
+    async def connect(self):
+        self._ready.set()
+        await self._closed.wait()
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    async def logout(self):
+        self.is_closed = True
+        self._closed.set()
+
+
+@pytest.fixture
+def client_manager():
+    client_manager = ClientManager(idle_timeout=0.1,
+                                   client_factory=FakeSessionClient)
+    client_manager.start()
+    yield client_manager
+    client_manager.stop()
+
+
+def test_client_manager_reuses_sessions(client_manager):
+    for _ in range(3):
+        server_data = client_manager.scrape_server("token", "server", 5)
+        assert len(server_data["channels"]) == 2
+    client_manager.scrape_server("other token", "server", 5)
+    assert client_manager.get_metrics() == {
+        "sessions": 2,
+        "logins": 2,
+        "logins_avoided": 2,
+        "evictions": 0,
+    }
+
+
+def test_client_manager_evicts_idle_sessions(client_manager):
+    client_manager.scrape_server("token", "server", 5)
+    for _ in range(50):
+        if client_manager.evictions:
+            break
+        time.sleep(0.05)
+    assert client_manager.get_metrics()["sessions"] == 0
+    client_manager.scrape_server("token", "server", 5)
+    assert client_manager.logins == 2
+
+
+def test_client_manager_login_locks(client_manager):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(client_manager.scrape_server, "token",
+                                       "server", 5) for _ in range(4)]:
+            future.result()
+    assert client_manager.logins == 1
+    # the login locks are dropped once no login is pending, and neither
+    # they nor the sessions hold the token itself
+    assert client_manager._login_locks == {}
+    assert list(client_manager._sessions) == [get_token_scope("token")]
+
+
+def test_client_manager_replaces_dead_sessions(client_manager):
+    client_manager.scrape_server("token", "server", 5)
+    session = client_manager._sessions[get_token_scope("token")]
+    # the connection is lost without the client being logged out
+    client_manager.loop.call_soon_threadsafe(session.connection.cancel)
+    for _ in range(50):
+        if session.connection.done():
+            break
+        time.sleep(0.01)
+    client_manager.scrape_server("token", "server", 5)
+    assert client_manager.logins == 2
+    assert session.client.is_closed
+    assert client_manager._sessions[get_token_scope("token")] is not session
+
+
+def test_client_manager_timings(client_manager):
+    METRICS.start_timings()
+    client_manager.scrape_server("token", "server", 5)
+    client_manager.scrape_server("token", "server", 5)
+    # the stages run on the manager's thread are part of the caller's
+    # timings
+    assert [stage for stage, _ in METRICS.stop_timings()] == \
+        ["login", "fetch", "fetch"]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+from logging.handlers import QueueHandler
+
+import pytest
+
+from undiscord.common import add_log_parser, init_logging, \
+    concurrency_number, MAX_CONCURRENCY
+
+
+def test_init_logging_async(tmpdir):
+    parser = argparse.ArgumentParser()
+    add_log_parser(parser)
+    args = parser.parse_args(["--async-logging", "--log-dir", str(tmpdir)])
+    listener = init_logging(args, "test.log")
+    assert listener is not None
+    record = logging.LogRecord("test", logging.INFO, __file__, 1,
+                               "logged %s", ("asynchronously",), None)
+    QueueHandler(listener.queue).handle(record)
+    listener.queue.join()
+    assert "logged asynchronously" in tmpdir.join("test.log").read()
+
+
+def test_init_logging_sync(tmpdir):
+    parser = argparse.ArgumentParser()
+    add_log_parser(parser)
+    args = parser.parse_args(["--log-dir", str(tmpdir)])
+    assert init_logging(args, "test.log") is None
+
+
+def test_concurrency_number():
+    assert concurrency_number("3") == 3
+    assert concurrency_number(str(MAX_CONCURRENCY + 1)) == MAX_CONCURRENCY
+    for value in ["0", "-1", "many"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            concurrency_number(value)
@@ -1,6 +1,14 @@
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from json import loads
 
-from undiscord.friend_map import FriendMap
+import pytest
+
+from undiscord.friend_map import FriendMap, PlotlyAdapter, JSONAdapter, \
+    LINE_COLORS, get_plotlyjs_filename, write_plotlyjs
 
 MOCK_SERVER_DATA = loads("""
 {
@@ -166,3 +174,103 @@ def test_graph_edges():
     assert (list(friends.graph.edges()) == [('user 1', 'user 2'), ('user 2', 'user 1')])
     assert friends.graph["user 1"]["user 2"]['weight'] == 2
     assert friends.graph["user 2"]["user 1"]['weight'] == 3
+
+
+def test_add_connection_counts():
+    friends = FriendMap(MOCK_SERVER_DATA)
+    friends.add_connection_counts({("user 1", "user 2"): 3,
+                                   ("user 2", "user 3"): 1})
+    assert friends.graph["user 1"]["user 2"]['weight'] == 5
+    assert friends.graph["user 2"]["user 1"]['weight'] == 3
+    assert friends.graph["user 2"]["user 3"]['weight'] == 1
+
+
+@pytest.mark.parametrize("split", [0, 1, 5, 9, 13])
+def test_update(split):
+    old_server_data = deepcopy(MOCK_SERVER_DATA)
+    new_server_data = deepcopy(MOCK_SERVER_DATA)
+    # messages are ordered newest first
+    old_server_data["channels"][0]["messages"] = \
+        old_server_data["channels"][0]["messages"][split:]
+    friends = FriendMap(old_server_data)
+    friends.update(new_server_data)
+    assert sorted(friends.graph.edges(data='weight')) == \
+        sorted(FriendMap(MOCK_SERVER_DATA).graph.edges(data='weight'))
+    assert set(friends.graph.nodes()) == {"user 1", "user 2"}
+
+
+def test_streamed_channels():
+    friends = FriendMap({"name": MOCK_SERVER_DATA["name"],
+                         "channels": iter(MOCK_SERVER_DATA["channels"])})
+    assert sorted(friends.graph.edges(data='weight')) == \
+        sorted(FriendMap(MOCK_SERVER_DATA).graph.edges(data='weight'))
+    assert list(friends.channel_tails) == ["00002"]
+
+
+def test_plotly_adapter():
+    friends = FriendMap(MOCK_SERVER_DATA)
+    friends.add_connection_counts({("user 1", "user 3"): 30})
+    adapter = PlotlyAdapter(friends, "random")
+    assert len(adapter.node_trace.x) == 3
+    assert list(adapter.node_trace.marker.color) == \
+        [len(friends.graph[node]) for node in friends.graph]
+    assert adapter.node_trace.text[0].startswith("user 1<br>Connections (")
+    # one trace per edge colour, ordered by increasing weight
+    colors = [trace.line.color for trace in adapter.edge_trace]
+    assert colors == sorted(set(colors), key=LINE_COLORS.index)
+    assert colors[-1] == PlotlyAdapter.get_line_color(30)
+    assert sum(trace.x.count(None) for trace in adapter.edge_trace) == \
+        friends.graph.number_of_edges()
+    assert "<div" in adapter.get_html()
+
+
+def test_plot_graph_shared_plotlyjs(tmpdir):
+    adapter = PlotlyAdapter(FriendMap(MOCK_SERVER_DATA), "random")
+    filename = get_plotlyjs_filename()
+    path = write_plotlyjs(str(tmpdir))
+    assert os.path.basename(path) == filename
+    graph_path = tmpdir.join("graph.html")
+    adapter.plot_graph(str(graph_path), filename)
+    assert "<script src='{}'>".format(filename) in graph_path.read()
+    assert graph_path.size() * 10 < os.path.getsize(path)
+
+
+def test_write_plotlyjs_concurrent(tmpdir):
+    with ThreadPoolExecutor(4) as executor:
+        paths = set(executor.map(lambda _: write_plotlyjs(str(tmpdir)),
+                                 range(4)))
+    assert [os.path.basename(path) for path in paths] == \
+        [get_plotlyjs_filename()]
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_json_adapter(tmpdir):
+    friends = FriendMap(MOCK_SERVER_DATA)
+    adapter = JSONAdapter(friends, "random")
+    graph_data = adapter.get_data()
+    nodes = graph_data["nodes"]
+    assert sorted(nodes) == sorted(friends.graph)
+    assert graph_data["degree"] == [len(friends.graph[node]) for node in nodes]
+    for i, node in enumerate(nodes):
+        assert graph_data["x"][i] == pytest.approx(adapter.positions[node][0],
+                                                   abs=1e-5)
+    assert sorted((nodes[source], nodes[target], weight)
+                  for source, target, weight, _ in graph_data["edges"]) == \
+        sorted(friends.graph.edges(data="weight"))
+    for _, _, weight, color in graph_data["edges"]:
+        assert graph_data["lineColors"][color] == \
+            PlotlyAdapter.get_line_color(weight)
+    graph_path = tmpdir.join("graph.json")
+    adapter.write_graph(str(graph_path))
+    assert loads(graph_path.read()) == graph_data
+
+
+def test_friend_map_lazy_imports():
+    # the graph modules can be imported without the plotting and layout
+    # libraries, which are only imported once a graph is built
+    output = subprocess.check_output(
+        [sys.executable, "-W", "ignore", "-c",
+         "import sys, undiscord.friend_map; print(' '.join(sorted("
+         "{'matplotlib', 'networkx', 'plotly', 'scipy'} & "
+         "set(sys.modules))))"])
+    assert output.decode().strip() == ""
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+import networkx as nx
+import numpy as np
+import pytest
+
+import undiscord.graph_layout
+from undiscord.common import LAYOUT_NAMES
+from undiscord.friend_map import layouts
+from undiscord.graph_layout import grid_layout, load_positions, \
+    save_positions
+
+
+def make_random_graph(nodes_number, edges_number, seed=0):
+    random = Random(seed)
+    graph = nx.DiGraph()
+    graph.add_nodes_from("user {}".format(i) for i in range(nodes_number))
+    for _ in range(edges_number):
+        graph.add_edge("user {}".format(random.randrange(nodes_number)),
+                       "user {}".format(random.randrange(nodes_number)),
+                       weight=random.randrange(1, 10))
+    return graph
+
+
+def test_layout_names():
+    assert sorted(layouts) == sorted(LAYOUT_NAMES)
+
+
+@pytest.mark.parametrize("layout", sorted(layouts))
+@pytest.mark.parametrize("nodes_number", [0, 1, 2, 50])
+def test_layouts(layout, nodes_number):
+    graph = make_random_graph(nodes_number, nodes_number * 2)
+    positions = layouts[layout](graph)
+    assert set(positions) == set(graph)
+    for position in positions.values():
+        assert len(position) == 2
+        assert np.all(np.isfinite(position))
+
+
+def test_grid_layout_connected_closer():
+    # two cliques are laid out apart from each other
+    graph = nx.disjoint_union(nx.complete_graph(20), nx.complete_graph(20))
+    positions = grid_layout(graph)
+    first = np.array([positions[i] for i in range(20)])
+    second = np.array([positions[i] for i in range(20, 40)])
+    assert np.linalg.norm(first.mean(axis=0) - second.mean(axis=0)) > \
+        np.linalg.norm(first - first.mean(axis=0), axis=1).mean()
+
+
+def test_grid_layout_time_budget():
+    graph = make_random_graph(2000, 4000)
+    positions = grid_layout(graph, iterations=10 ** 6, time_budget=0.2)
+    assert len(positions) == 2000
+
+
+def test_auto_layout(monkeypatch):
+    monkeypatch.setattr(undiscord.graph_layout, "SCALABLE_LAYOUT_THRESHOLD", 10)
+    used = []
+    monkeypatch.setattr(undiscord.graph_layout, "grid_layout",
+                        lambda graph, pos: used.append(len(graph)) or {})
+    undiscord.graph_layout.auto_layout(make_random_graph(5, 5))
+    undiscord.graph_layout.auto_layout(make_random_graph(20, 20))
+    assert used == [20]
+
+
+@pytest.mark.parametrize("layout", ["grid", "reingold"])
+def test_warm_start(layout):
+    graph = make_random_graph(100, 300)
+    positions = layouts[layout](graph)
+    graph.add_edge("user 0", "new user", weight=1)
+    warm_positions = layouts[layout](graph, positions)
+    assert set(warm_positions) == set(graph)
+    # the previously positioned nodes mostly keep their place
+    moved = np.mean([np.linalg.norm(warm_positions[node] - positions[node])
+                     for node in positions])
+    cold_moved = np.mean([np.linalg.norm(warm_positions[node] - position)
+                          for node, position in
+                          layouts[layout](graph, None).items()
+                          if node in positions])
+    assert moved < cold_moved / 2
+
+
+def test_save_positions(tmpdir):
+    path = str(tmpdir.join("positions", "server.json"))
+    assert load_positions(path) is None
+    positions = grid_layout(make_random_graph(10, 20))
+    save_positions(path, positions)
+    loaded = load_positions(path)
+    assert set(loaded) == set(positions)
+    for node, position in positions.items():
+        assert np.allclose(loaded[node], position)
+    tmpdir.join("positions", "server.json").write("not json")
+    assert load_positions(path) is None
+
+
+def test_save_positions_concurrent(tmpdir):
+    path = str(tmpdir.join("server.json"))
+    positions = grid_layout(make_random_graph(100, 200))
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: save_positions(path, positions),
+                          range(32)))
+    assert set(load_positions(path)) == set(positions)
+    assert tmpdir.listdir() == [tmpdir.join("server.json")]
+
+
+def test_spectral_layout_disconnected():
+    pytest.importorskip("scipy")
+    graph = nx.disjoint_union(make_random_graph(30, 90),
+                              make_random_graph(30, 90, seed=1))
+    graph.add_nodes_from("isolated {}".format(i) for i in range(20))
+    positions = undiscord.graph_layout.spectral_layout(graph)
+    assert set(positions) == set(graph)
+    # isolated nodes are not all placed on the same point
+    isolated = {tuple(np.round(positions["isolated {}".format(i)], 6))
+                for i in range(20)}
+    assert len(isolated) == 20
+    # and neither are the nodes of each component
+    assert len({tuple(np.round(position, 6))
+                for position in positions.values()}) == len(graph)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+from copy import deepcopy
+
+import pendulum
+import pytest
+
+from test_friend_map import MOCK_SERVER_DATA
+from test_reply_pry import make_random_channel
+from undiscord.friend_map import FriendMap
+from undiscord.message_store import ServerStore, parse_timestamp
+from undiscord.reply_pry import get_connections_from_server, \
+    get_connection_counts_from_server
+
+RANDOM_SERVER_DATA = {
+    "name": "random",
+    "id": "00003",
+    "channels": [make_random_channel(seed, ordered=seed % 2 == 0)
+                 for seed in range(4)]
+}
+
+
+@pytest.mark.parametrize("timestamp", [
+    "2018-11-11 11:27:09.000000",
+    "2018-11-11 11:27:09.123456",
+    "2018-11-11 11:27:09",
+    "2018-11-11T11:27:09.5+01:00",
+])
+def test_parse_timestamp(timestamp):
+    assert parse_timestamp(timestamp) == pendulum.parse(timestamp).timestamp()
+
+
+@pytest.mark.parametrize("server_data", [MOCK_SERVER_DATA, RANDOM_SERVER_DATA])
+def test_server_store_round_trip(server_data):
+    server_store = ServerStore.from_server_data(server_data)
+    for channel, channel_store in zip(server_data["channels"],
+                                      server_store.channels):
+        channel_data = channel_store.to_channel_data(server_store.authors)
+        assert channel_data["id"] == channel["id"]
+        assert [(message["author"], message["epoch"], message["mentions"])
+                for message in channel_data["messages"]] == \
+            [(message["author"], message["epoch"], message["mentions"])
+             for message in channel["messages"]]
+
+
+@pytest.mark.parametrize("server_data", [MOCK_SERVER_DATA, RANDOM_SERVER_DATA])
+def test_server_store_connections(server_data):
+    server_store = ServerStore.from_server_data(server_data)
+    connection_counts = Counter(get_connections_from_server(server_data))
+    assert Counter(get_connections_from_server(server_store)) == \
+        connection_counts
+    assert get_connection_counts_from_server(server_store) == \
+        connection_counts
+
+
+def test_server_store_friend_map():
+    server_store = ServerStore.from_server_data(MOCK_SERVER_DATA)
+    friends = FriendMap(server_store)
+    expected = FriendMap(MOCK_SERVER_DATA)
+    assert list(friends.graph.nodes()) == list(expected.graph.nodes())
+    assert list(friends.graph.edges(data='weight')) == \
+        list(expected.graph.edges(data='weight'))
+    assert [message["epoch"] for message in friends.channel_tails["00002"]] == \
+        [message["epoch"] for message in expected.channel_tails["00002"]]
+
+
+def test_server_store_friend_map_update():
+    old_server_data = deepcopy(MOCK_SERVER_DATA)
+    old_server_data["channels"][0]["messages"] = \
+        old_server_data["channels"][0]["messages"][5:]
+    friends = FriendMap(ServerStore.from_server_data(old_server_data))
+    friends.update(ServerStore.from_server_data(MOCK_SERVER_DATA))
+    assert sorted(friends.graph.edges(data='weight')) == \
+        sorted(FriendMap(MOCK_SERVER_DATA).graph.edges(data='weight'))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from undiscord.metrics import Metrics, STAGE_SECONDS
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.describe("messages_total", "counter", "Messages")
+    metrics.inc("messages_total", 2)
+    metrics.inc("messages_total", 3)
+    metrics.inc("skipped_total", reason='say "hi"')
+    metrics.observe(STAGE_SECONDS, 0.5, stage="layout")
+    metrics.observe(STAGE_SECONDS, 1.5, stage="layout")
+    metrics.add_callback("sessions", "gauge", "Sessions", lambda: 4)
+    lines = metrics.render().splitlines()
+    assert "# HELP messages_total Messages" in lines
+    assert "# TYPE messages_total counter" in lines
+    assert "messages_total 5.0" in lines
+    assert 'skipped_total{reason="say \\"hi\\""} 1.0' in lines
+    assert 'undiscord_stage_seconds_count{stage="layout"} 2.0' in lines
+    assert 'undiscord_stage_seconds_sum{stage="layout"} 2.0' in lines
+    assert "# TYPE sessions gauge" in lines
+    assert "sessions 4.0" in lines
+
+
+def test_timings():
+    metrics = Metrics()
+    with metrics.time("untracked"):
+        pass
+    metrics.start_timings()
+    with metrics.time("fetch"):
+        pass
+    metrics.record("login", 2.0)
+    assert [stage for stage, _ in metrics.stop_timings()] == \
+        ["fetch", "login"]
+    assert metrics.stop_timings() == []
+    assert metrics.get_value(STAGE_SECONDS, stage="login") == 2.0
+    assert metrics.get_value(STAGE_SECONDS, stage="untracked") >= 0
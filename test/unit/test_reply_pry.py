@@ -1,9 +1,20 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from json import loads
+from random import Random
 
-from undiscord.reply_pry import get_connections_from_server
+import pendulum
+import pytest
+
+import undiscord.reply_pry
+from undiscord.reply_pry import get_connections_from_server, \
+    get_possible_connections_from_channel, get_replies_from_channel, \
+    is_reply_time, REPLY_TIME, get_edge_arrays_from_server, \
+    get_connection_counts_from_server, ProcessPool
 
 MOCK_SERVER_DATA = loads("""
 {
@@ -173,3 +184,113 @@ def test_get_possible_connections_from_server():
         ('user 2', 'user 1'),
         ('user 1', 'user 2')
     ]
+
+
+def make_random_channel(seed: int, size: int = 300, ordered: bool = False):
+    rand = Random(seed)
+    start = datetime(2018, 11, 11, 11, 0, 0)
+    messages = []
+    for i in range(size):
+        author = rand.randint(1, 5)
+        # mostly ordered with occasional out of order timestamps
+        offset = timedelta(seconds=i * 4 if ordered or rand.random() > 0.1
+                           else i * rand.uniform(0, 8),
+                           microseconds=rand.choice([0, 500000]))
+        mentioned = rand.randint(1, 5)
+        messages.append({
+            "author": {"name": "user {}".format(author), "id": str(author)},
+            "timestamp": str(start - offset),
+            "mentions": [
+                {"name": "user {}".format(mentioned), "id": str(mentioned)}
+            ] if rand.random() < 0.1 else []
+        })
+    return {"name": "random channel", "id": str(seed), "messages": messages}
+
+
+@pytest.mark.parametrize("channel", [MOCK_SERVER_DATA["channels"][0]] +
+                         [make_random_channel(seed) for seed in range(5)])
+def test_get_replies_from_channel(channel):
+    assert Counter(get_replies_from_channel(channel)) == \
+        Counter(get_possible_connections_from_channel(channel))
+
+
+@pytest.mark.parametrize("timestamp, next_timestamp", [
+    ("2018-11-11 11:27:30.000000", "2018-11-11 11:27:10.000000"),
+    ("2018-11-11 11:27:30.000000", "2018-11-11 11:27:09.000001"),
+    ("2018-11-11 11:27:30.000000", "2018-11-11 11:27:09.000000"),
+    ("2018-11-11 11:27:09.100000", "2018-11-11 11:27:30.100000"),
+    ("2018-11-11 11:27:09.100000", "2018-11-11 11:27:30.099999"),
+])
+def test_is_reply_time(timestamp, next_timestamp):
+    assert is_reply_time({"timestamp": timestamp},
+                         {"timestamp": next_timestamp}) == \
+        (pendulum.parse(next_timestamp).diff(
+            pendulum.parse(timestamp)).in_seconds() <= REPLY_TIME)
+
+
+@pytest.mark.parametrize("server_data", [MOCK_SERVER_DATA, {
+    "name": "random",
+    "id": "00003",
+    "channels": [make_random_channel(seed, ordered=seed % 2 == 0)
+                 for seed in range(6)] +
+                [{"name": "empty", "id": "00004", "messages": []}]
+}])
+def test_get_edge_arrays_from_server(server_data):
+    edge_arrays = get_edge_arrays_from_server(server_data)
+    edge_counts = Counter()
+    for src, dst, count in zip(edge_arrays.src, edge_arrays.dst,
+                               edge_arrays.count):
+        edge_counts[edge_arrays.names[src], edge_arrays.names[dst]] += count
+    assert edge_counts == Counter(get_connections_from_server(server_data))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_get_connection_counts_from_server(monkeypatch, workers, streamed):
+    monkeypatch.setattr(undiscord.reply_pry, "PARALLEL_MESSAGES_THRESHOLD", 0)
+    channels = [make_random_channel(seed) for seed in range(6)]
+    server_data = {
+        "name": "random",
+        "id": "00003",
+        "channels": iter(channels) if streamed else channels
+    }
+    assert get_connection_counts_from_server(server_data, workers) == \
+        Counter(get_connections_from_server({"channels": channels}))
+
+
+@pytest.mark.parametrize("threshold", [0, 150, 10 ** 6])
+def test_get_connection_counts_from_stream(monkeypatch, threshold):
+    # streamed channels are fanned out by default once they add up to the
+    # threshold
+    monkeypatch.setattr(undiscord.reply_pry, "PARALLEL_MESSAGES_THRESHOLD",
+                        threshold)
+    submitted = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(args[0])
+            return super().submit(fn, *args, **kwargs)
+
+    monkeypatch.setattr(undiscord.reply_pry, "ProcessPoolExecutor",
+                        RecordingExecutor)
+    monkeypatch.setattr(undiscord.reply_pry.os, "cpu_count", lambda: 2)
+    channels = [make_random_channel(seed) for seed in range(6)]
+    assert get_connection_counts_from_server({"channels": iter(channels)}) == \
+        Counter(get_connections_from_server({"channels": channels}))
+    messages_numbers = [len(channel["messages"]) for channel in channels]
+    if threshold > sum(messages_numbers):
+        assert not submitted
+    else:
+        assert submitted
+        assert sum(messages_numbers[:-len(submitted)]) >= threshold
+
+
+def test_process_pool():
+    pool = ProcessPool(2)
+    channels = [make_random_channel(seed) for seed in range(4)]
+    try:
+        assert get_connection_counts_from_server(
+            {"channels": iter(channels)}, executor=pool) == \
+            Counter(get_connections_from_server({"channels": channels}))
+    finally:
+        pool.shutdown()
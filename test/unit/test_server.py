@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+import undiscord.server.server
+from test_reply_pry import MOCK_SERVER_DATA
+from undiscord.friend_map import get_plotlyjs_filename
+from undiscord.message_cache import MessageCache
+from undiscord.metrics import METRICS
+from undiscord.reply_pry import get_connections_from_server, \
+    get_connection_counts_from_server
+from undiscord.server.graph_cache import GraphCache
+from undiscord.server.jobs import JobQueue, JobQueueFull, DONE, FAILED
+
+ARGS = {"token": "token", "server_name": "ex"}
+
+
+@pytest.fixture
+def scrapes(monkeypatch):
+    scrapes = []
+
+    def scrape_server(**kwargs):
+        scrapes.append(kwargs)
+        return MOCK_SERVER_DATA
+
+    monkeypatch.setattr(undiscord.server.server, "scrape_server",
+                        scrape_server)
+    return scrapes
+
+
+@pytest.fixture
+def client(monkeypatch, tmpdir, scrapes):
+    monkeypatch.setattr(undiscord.server.server, "GRAPH_DIR", str(tmpdir))
+    monkeypatch.setattr(undiscord.server.server, "JOB_QUEUE", JobQueue(1, 1))
+    monkeypatch.setattr(undiscord.server.server, "GRAPH_CACHE", GraphCache())
+    return undiscord.server.server.APP.test_client()
+
+
+def wait_for_job(client, job_id):
+    for _ in range(100):
+        job_data = client.get("/api/jobs/{}".format(job_id)).get_json()
+        if job_data["status"] in (DONE, FAILED):
+            return job_data
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_connections_job(client):
+    response = client.post("/api/jobs/connections", data=ARGS)
+    assert response.status_code == 202
+    job_data = wait_for_job(client, response.get_json()["jobId"])
+    assert job_data["status"] == DONE
+    response = client.get(job_data["resultURL"])
+    assert response.status_code == 200
+    assert response.get_json() == \
+        [list(pair) for pair in get_connections_from_server(MOCK_SERVER_DATA)]
+
+
+def test_connections(client):
+    response = client.post("/api/connections", data=ARGS)
+    assert response.status_code == 201
+    assert response.get_json() == \
+        [list(pair) for pair in get_connections_from_server(MOCK_SERVER_DATA)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 1000])
+def test_connections_stream(client, monkeypatch, chunk_size):
+    monkeypatch.setattr(undiscord.server.server, "STREAM_CHUNK_SIZE",
+                        chunk_size)
+    pairs = [list(pair) for pair in
+             get_connections_from_server(MOCK_SERVER_DATA)]
+    response = client.post("/api/connections",
+                           data=dict(ARGS, stream="json"))
+    assert response.status_code == 201
+    assert response.get_json() == pairs
+    response = client.post("/api/connections",
+                           data=dict(ARGS, stream="ndjson"))
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).split("\n")
+    assert lines[-1] == ""
+    assert [json.loads(line) for line in lines[:-1]] == pairs
+
+
+def test_connections_stream_metrics(client):
+    def get_count():
+        for line in METRICS.render().splitlines():
+            if line.startswith(
+                    'undiscord_stage_seconds_count{stage="reply_pry"}'):
+                return float(line.split()[-1])
+        return 0
+
+    count = get_count()
+    client.post("/api/connections", data=dict(ARGS, stream="ndjson"))
+    assert get_count() == count + 1
+
+
+@pytest.mark.parametrize("data", [{}, {"stream": "json"}])
+def test_connections_aggregate(client, data):
+    response = client.post("/api/connections",
+                           data=dict(ARGS, aggregate="true", **data))
+    assert response.status_code == 201
+    assert {(src, dst): count for src, dst, count in response.get_json()} \
+        == get_connection_counts_from_server(MOCK_SERVER_DATA)
+
+
+@pytest.mark.parametrize("concurrency", ["0", "-1"])
+def test_connections_invalid_concurrency(client, scrapes, concurrency):
+    response = client.post("/api/connections",
+                           data=dict(ARGS, concurrency=concurrency))
+    assert response.status_code == 400
+    assert not scrapes
+
+
+def test_connections_stream_empty(client, scrapes, monkeypatch):
+    monkeypatch.setattr(undiscord.server.server, "scrape_server",
+                        lambda **kwargs: {"channels": []})
+    assert client.post("/api/connections",
+                       data=dict(ARGS, stream="json")).get_json() == []
+    assert client.post("/api/connections", data=dict(
+        ARGS, stream="ndjson")).get_data(as_text=True) == ""
+
+
+def test_graph_job(client, tmpdir):
+    response = client.post("/api/jobs/graph", data=ARGS)
+    job_data = wait_for_job(client, response.get_json()["jobId"])
+    graph_url = client.get(job_data["resultURL"]).get_json()["graphURL"]
+    assert tmpdir.join("{}.html".format(graph_url.split("/")[-1])).check()
+
+
+def test_graph_shared_plotlyjs(client, tmpdir):
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    html = client.get(graph_url).get_data(as_text=True)
+    assert "assets/{}".format(get_plotlyjs_filename()) in html
+    # the graph no longer embeds plotly.js
+    assert len(html) < 100000
+    response = client.get(
+        "/graph/assets/{}".format(get_plotlyjs_filename()))
+    assert response.status_code == 200
+    assert response.cache_control.max_age == \
+        undiscord.server.server.ASSET_CACHE_TIMEOUT
+    response.close()
+
+
+def test_graph_json(client, scrapes):
+    response = client.post("/api/graph", data=dict(ARGS, format="json"))
+    graph_urls = response.get_json()
+    assert graph_urls["graphURL"].endswith("/view")
+    response = client.get(graph_urls["dataURL"])
+    graph_data = response.get_json()
+    response.close()
+    assert sorted(graph_data["nodes"]) == ["user 1", "user 2"]
+    assert len(graph_data["edges"]) == 2
+    html = client.get(graph_urls["graphURL"]).get_data(as_text=True)
+    assert graph_urls["dataURL"] in html
+    assert "/graph/assets/{}".format(get_plotlyjs_filename()) in html
+    # JSON and HTML graphs are cached separately
+    assert client.post("/api/graph", data=dict(ARGS, format="json")) \
+        .get_json() == graph_urls
+    assert len(scrapes) == 1
+
+
+def test_metrics(client):
+    client.post("/api/graph", data=ARGS)
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    for stage in ["friend_map", "layout", "plot"]:
+        assert 'undiscord_stage_seconds_count{{stage="{}"}}'.format(stage) \
+            in text
+    assert "undiscord_graph_nodes_total" in text
+    assert "undiscord_scrapes_total" in text
+    assert "undiscord_client_sessions 0.0" in text
+
+
+def test_server_timing(client, monkeypatch):
+    assert "Server-Timing" not in client.post("/api/connections",
+                                              data=ARGS).headers
+    monkeypatch.setattr(undiscord.server.server, "SERVER_TIMING", True)
+    response = client.post("/api/graph", data=ARGS)
+    stages = [timing.split(";")[0] for timing in
+              response.headers["Server-Timing"].split(", ")]
+    assert stages == ["friend_map", "layout", "plot"]
+    assert "Server-Timing" not in client.get("/metrics").headers
+
+
+def test_unknown_job(client):
+    assert client.get("/api/jobs/missing").status_code == 404
+    assert client.get("/api/jobs/missing/result").status_code == 404
+
+
+def test_job_queue_full():
+    job_queue = JobQueue(workers=1, queue_depth=1)
+    release = Event()
+    jobs = [job_queue.submit("wait", release.wait) for _ in range(2)]
+    with pytest.raises(JobQueueFull):
+        job_queue.submit("wait", release.wait)
+    release.set()
+    for _ in range(100):
+        if all(job.status == DONE for job in jobs):
+            break
+        time.sleep(0.05)
+    assert all(job.status == DONE for job in jobs)
+    job_queue.submit("wait", release.wait)
+
+
+def test_job_queue_failed():
+    job_queue = JobQueue(workers=1, queue_depth=0)
+    job = job_queue.submit("fail", lambda: 1 / 0)
+    for _ in range(100):
+        if job.status == FAILED:
+            break
+        time.sleep(0.05)
+    assert job.status == FAILED
+    assert "division" in job.error
+
+
+def test_connections_job_result_file(client, monkeypatch, tmpdir):
+    job_queue = JobQueue(1, 1, result_dir=str(tmpdir.join("jobs")))
+    monkeypatch.setattr(undiscord.server.server, "JOB_QUEUE", job_queue)
+    response = client.post("/api/jobs/connections", data=ARGS)
+    job_data = wait_for_job(client, response.get_json()["jobId"])
+    job = job_queue.get(job_data["jobId"])
+    # the result is kept on disk rather than in memory
+    assert job.result is None
+    assert client.get(job_data["resultURL"]).get_json() == \
+        [list(pair) for pair in get_connections_from_server(MOCK_SERVER_DATA)]
+    job_queue.finished_job_ttl = 0
+    assert client.get(job_data["resultURL"]).status_code == 404
+    assert tmpdir.join("jobs").listdir() == []
+
+
+def test_job_queue_finished_jobs(tmpdir):
+    job_queue = JobQueue(workers=1, queue_depth=4, finished_jobs=2,
+                         result_dir=str(tmpdir))
+    jobs = [job_queue.submit("count", lambda i=i: i) for i in range(4)]
+    for _ in range(100):
+        if all(job.status == DONE for job in jobs):
+            break
+        time.sleep(0.05)
+    # only the newest finished jobs and their results are kept
+    assert [job_queue.get(job.id) for job in jobs] == [None, None] + jobs[2:]
+    assert sorted(path.basename for path in tmpdir.listdir()) == \
+        sorted("{}.json".format(job.id) for job in jobs[2:])
+
+
+def test_job_queue_finished_jobs_order():
+    job_queue = JobQueue(workers=2, queue_depth=0, finished_jobs=1)
+    release = Event()
+    slow_job = job_queue.submit("wait", release.wait)
+    fast_job = job_queue.submit("count", lambda: 1)
+    for _ in range(100):
+        if fast_job.status == DONE:
+            break
+        time.sleep(0.05)
+    release.set()
+    for _ in range(100):
+        if slow_job.status == DONE:
+            break
+        time.sleep(0.05)
+    # the last job to finish is kept rather than the last job submitted
+    assert job_queue.get(slow_job.id) is slow_job
+    assert job_queue.get(fast_job.id) is None
+
+
+def test_graph_cached(client, scrapes, tmpdir):
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    assert client.post("/api/graph", data=ARGS).get_json()["graphURL"] == \
+        graph_url
+    assert len(scrapes) == 1
+    other_args = dict(ARGS, messages_number=10)
+    assert client.post("/api/graph", data=other_args).get_json()["graphURL"] \
+        != graph_url
+    assert len(scrapes) == 2
+    assert len(tmpdir.listdir("*.html")) == 2
+
+
+def test_graph_truncated_not_cached(client, monkeypatch):
+    truncated_data = dict(MOCK_SERVER_DATA, truncated_channels=["00002"])
+    monkeypatch.setattr(undiscord.server.server, "scrape_server",
+                        lambda **kwargs: truncated_data)
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    assert client.post("/api/graph", data=ARGS).get_json()["graphURL"] != \
+        graph_url
+    # the truncated graphs' files are still bounded by the cache
+    assert len(undiscord.server.server.GRAPH_CACHE) == 2
+
+
+def test_graph_key_server_version(client, monkeypatch, tmpdir):
+    cache = MessageCache(str(tmpdir.join("cache.sqlite")))
+    monkeypatch.setattr(undiscord.server.server, "MESSAGE_CACHE", cache)
+    monkeypatch.setattr(undiscord.server.server, "SERVER_IDS", {})
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    message = MOCK_SERVER_DATA["channels"][0]["messages"][0]
+    # new messages of another server of the same name keep the graph
+    cache.add_messages("other", "0", [dict(message, id="99")])
+    assert client.post("/api/graph", data=ARGS).get_json()["graphURL"] == \
+        graph_url
+    cache.add_messages(MOCK_SERVER_DATA["id"], "0", [dict(message, id="99")])
+    assert client.post("/api/graph", data=ARGS).get_json()["graphURL"] != \
+        graph_url
+
+
+def test_graph_layout(client, scrapes):
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    grid_args = dict(ARGS, layout="grid")
+    assert client.post("/api/graph", data=grid_args).get_json()["graphURL"] \
+        != graph_url
+    # graphs of each layout are cached separately
+    assert client.post("/api/graph", data=grid_args).get_json()["graphURL"] \
+        != graph_url
+    assert len(scrapes) == 2
+    response = client.post("/api/graph", data=dict(ARGS, layout="unknown"))
+    assert response.status_code == 400
+
+
+def test_graph_default_layout(client, scrapes, monkeypatch):
+    monkeypatch.setattr(undiscord.server.server, "GRAPH_LAYOUT", "grid")
+    graph_url = client.post("/api/graph", data=ARGS).get_json()["graphURL"]
+    # graphs requested without a layout use the server's layout
+    grid_args = dict(ARGS, layout="grid")
+    assert client.post("/api/graph", data=grid_args).get_json()["graphURL"] \
+        == graph_url
+    assert len(scrapes) == 1
+
+
+def test_graph_positions_saved(client, tmpdir):
+    client.post("/api/graph", data=ARGS)
+    positions_files = tmpdir.join("positions").listdir()
+    assert len(positions_files) == 1
+    # the next graph of the server is warm started from the saved positions
+    positions_files[0].write('{"user 1": [0.5, 0.5]}')
+    client.post("/api/graph", data=dict(ARGS, messages_number=10))
+    assert len(tmpdir.join("positions").listdir()) == 1
+    assert positions_files[0].read() != '{"user 1": [0.5, 0.5]}'
+
+
+def test_graph_positions_scope(client, tmpdir, monkeypatch):
+    client.post("/api/graph", data=ARGS)
+    positions_file = tmpdir.join("positions").listdir()[0]
+    # another token's server of the same name keeps its own positions
+    client.post("/api/graph", data=dict(ARGS, token="other token"))
+    assert len(tmpdir.join("positions").listdir()) == 2
+    # positions not updated within their time to live are deleted
+    os.utime(str(positions_file), (0, 0))
+    client.post("/api/graph", data=dict(ARGS, token="other token",
+                                        messages_number=10))
+    assert not positions_file.check()
+    assert len(tmpdir.join("positions").listdir()) == 1
+
+
+def test_graph_cache_eviction(tmpdir):
+    now = [0.0]
+    graph_cache = GraphCache(ttl=10, max_size=2, clock=lambda: now[0])
+    paths = []
+    for i in range(3):
+        paths.append(tmpdir.join("{}.html".format(i)))
+        paths[-1].write("graph")
+        graph_cache.put(i, str(paths[-1]), "/graph/{}".format(i))
+    assert not paths[0].check()
+    assert graph_cache.get(0) is None
+    assert graph_cache.get(1) == "/graph/1"
+    now[0] = 11
+    assert graph_cache.get(2) is None
+    assert not paths[2].check()
+    assert len(graph_cache) == 1
+
+
+@pytest.mark.parametrize("max_size", [0, 2])
+def test_graph_cache_not_reusable(tmpdir, max_size):
+    graph_cache = GraphCache(max_size=max_size)
+    paths = []
+    for i in range(3):
+        paths.append(tmpdir.join("{}.html".format(i)))
+        paths[-1].write("graph")
+        graph_cache.put(i, str(paths[-1]), "/graph/{}".format(i),
+                        reusable=i == 2)
+    # graphs that are not served again are still deleted when evicted
+    assert graph_cache.get(0) is None
+    assert graph_cache.get(2) == ("/graph/2" if max_size else None)
+    assert [path.check() for path in paths] == \
+        [False, bool(max_size), True]
+
+
+def test_single_flight():
+    single_flight = undiscord.server.server.SingleFlight()
+    release = Event()
+    calls = []
+
+    def scrape(server_name):
+        calls.append(server_name)
+        release.wait()
+        return {"name": server_name}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(single_flight.do, "ex", scrape, "ex")
+                   for _ in range(3)]
+        other = executor.submit(single_flight.do, "other", scrape, "other")
+        while single_flight.calls + single_flight.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+    assert results == [{"name": "ex"}] * 3
+    assert results[0] is results[1] is results[2]
+    assert other.result() == {"name": "other"}
+    assert sorted(calls) == ["ex", "other"]
+    assert single_flight.coalesced == 2
+    # finished calls are not shared with later callers
+    assert single_flight.do("ex", scrape, "ex") == {"name": "ex"}
+    assert len(calls) == 3
+
+
+def test_single_flight_error():
+    single_flight = undiscord.server.server.SingleFlight()
+    with pytest.raises(ZeroDivisionError):
+        single_flight.do("ex", lambda: 1 / 0)
+    assert single_flight.do("ex", lambda: 1) == 1
+
+
+def test_scrape_parameters(scrapes, monkeypatch):
+    args = dict(ARGS, messages_number=30, timeout=30.0, concurrency=4,
+                channel_timeout=None)
+    server_data = undiscord.server.server.scrape(args)
+    assert server_data == MOCK_SERVER_DATA
+    # each caller gets its own message records to add to
+    server_data["channels"][0]["messages"][0]["analysed"] = True
+    assert "analysed" not in MOCK_SERVER_DATA["channels"][0]["messages"][0]
+    release = Event()
+
+    def scrape_server(**kwargs):
+        scrapes.append(kwargs)
+        release.wait()
+        return {}
+
+    monkeypatch.setattr(undiscord.server.server, "scrape_server",
+                        scrape_server)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(undiscord.server.server.scrape,
+                                   dict(args, timeout=timeout))
+                   for timeout in (1.0, 60.0)]
+        while len(scrapes) < 3:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            future.result()
+    # scrapes with different timeouts are not shared
+    assert sorted(scrape["timeout"] for scrape in scrapes[1:]) == [1.0, 60.0]
+
+
+def test_server_main_lazy_imports():
+    # the server starts without the plotting, layout and discord libraries
+    output = subprocess.check_output(
+        [sys.executable, "-W", "ignore", "-c",
+         "import sys, undiscord.server.__main__; print(' '.join(sorted("
+         "{'discord', 'matplotlib', 'networkx', 'plotly', 'scipy'} & "
+         "set(sys.modules))))"])
+    assert output.decode().strip() == ""
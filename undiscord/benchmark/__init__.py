@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark suite for undiscord's connection finding and graph rendering"""
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""argparse and entry point script for the undiscord benchmark suite"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from copy import deepcopy
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import undiscord
+from undiscord.benchmark.synthetic import generate_server_data
+from undiscord.common import add_log_parser, init_logging
+from undiscord.friend_map import FriendMap, PlotlyAdapter, layouts
+from undiscord.reply_pry import get_connections_from_server
+
+__log__ = getLogger(__name__)
+
+# synthetic server data parameters of each benchmark scale
+SCALES = OrderedDict([
+    ("small", {"channels": 5, "messages_per_channel": 200, "authors": 50}),
+    ("medium", {"channels": 20, "messages_per_channel": 1000, "authors": 500}),
+    ("large", {"channels": 50, "messages_per_channel": 4000,
+               "authors": 5000}),
+])
+
+# modules imported by the console entry points, whose import time is
+# benchmarked in a fresh interpreter
+ENTRY_POINT_MODULES = OrderedDict([
+    ("undiscord-bot", "undiscord.bot.__main__"),
+    ("undiscord-server", "undiscord.server.__main__"),
+])
+
+DEFAULT_SCALES: List[str] = ["small", "medium"]
+DEFAULT_REPEAT: int = 3
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Create and return the argparser for the undiscord benchmark suite"""
+    parser = argparse.ArgumentParser(
+        description="Time and memory profile undiscord on synthetic Discord "
+                    "server data of increasing scales",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("-o", "--output-file", dest="output_file",
+                        help="Path to write the JSON results to, instead of "
+                             "stdout")
+    parser.add_argument("-s", "--scale", dest="scales", action="append",
+                        choices=list(SCALES),
+                        help="Scale of synthetic server data to benchmark, "
+                             "may be given multiple times (default: {})"
+                             .format(" ".join(DEFAULT_SCALES)))
+    parser.add_argument("-b", "--benchmark", dest="benchmarks",
+                        action="append",
+                        help="Name of a benchmark to run, may be given "
+                             "multiple times (default: all benchmarks)")
+    parser.add_argument("-r", "--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Number of times to time each benchmark")
+    parser.add_argument("--burstiness", type=float, default=0.7,
+                        help="Probability of a message following the "
+                             "previous one within the reply time")
+    parser.add_argument("--mention-rate", dest="mention_rate", type=float,
+                        default=0.05,
+                        help="Probability of a message mentioning an author")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic server data")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="Skip the tracemalloc memory profile of each "
+                             "benchmark")
+
+    add_log_parser(parser)
+
+    return parser
+
+
+Benchmark = Tuple[Optional[Callable[[], Any]], Callable[[Any], Any]]
+
+
+def get_benchmarks(server_data: dict,
+                   friend_map: FriendMap) -> Dict[str, Benchmark]:
+    """Return the benchmarks of the server data by name
+
+    Each benchmark is a function timed with the result of its untimed setup
+    function. The analysis stores each message's parsed timestamp in its
+    record, so the benchmarks of the raw server data are set up with a
+    fresh copy of it for every run, and the graph benchmarks share the
+    ``friend_map`` built from another copy.
+    """
+    def copy_server_data():
+        return deepcopy(server_data)
+
+    benchmarks = OrderedDict([
+        ("get_connections_from_server",
+         (copy_server_data,
+          lambda data: list(get_connections_from_server(data)))),
+        ("FriendMap", (copy_server_data, FriendMap)),
+    ])
+    for layout in layouts:
+        benchmarks["layout:{}".format(layout)] = (
+            None,
+            lambda _, layout=layout: layouts[layout](friend_map.get_graph()))
+    # the random layout leaves the time of building and serializing the figure
+    benchmarks["PlotlyAdapter"] = (
+        None, lambda _: PlotlyAdapter(friend_map, "random").get_html())
+    return benchmarks
+
+
+def run_benchmark(function: Callable[[Any], Any], repeat: int,
+                  memory: bool,
+                  setup: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+    """Time the function ``repeat`` times and profile the peak memory it
+    allocates, in the benchmarking process, in one more run
+
+    The function is called with the result of ``setup``, which is called
+    before each run outside of its timing and memory profile.
+    """
+    times = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    result = {
+        "times": times,
+        "min": min(times),
+        "mean": sum(times) / len(times),
+        "peak_memory": None,
+    }
+    if memory:
+        argument = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            function(argument)
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def time_import(module: str) -> float:
+    """Return the seconds importing the module takes in a fresh
+    interpreter, excluding the interpreter's own startup"""
+    output = subprocess.check_output(
+        [sys.executable, "-W", "ignore", "-c",
+         "import time; start = time.perf_counter(); import {}; "
+         "print(time.perf_counter() - start)".format(module)],
+        stderr=subprocess.DEVNULL
+    )
+    return float(output)
+
+
+def run_import_benchmarks(benchmark_names: List[str] = None,
+                          repeat: int = DEFAULT_REPEAT) -> List[dict]:
+    """Benchmark the import time of each console entry point"""
+    results = []
+    for entry_point, module in ENTRY_POINT_MODULES.items():
+        name = "import:{}".format(entry_point)
+        if benchmark_names and name not in benchmark_names:
+            continue
+        __log__.info("running benchmark: name: {}".format(name))
+        times = [time_import(module) for _ in range(repeat)]
+        results.append({
+            "scale": None,
+            "benchmark": name,
+            "module": module,
+            "times": times,
+            "min": min(times),
+            "mean": sum(times) / len(times),
+            "peak_memory": None,
+        })
+    return results
+
+
+def run_benchmarks(scales: List[str], benchmark_names: List[str] = None,
+                   repeat: int = DEFAULT_REPEAT, memory: bool = True,
+                   **server_data_kwargs) -> Dict[str, Any]:
+    """Run the import time benchmarks and the benchmarks at each scale, and
+    return the JSON serializable results"""
+    results = run_import_benchmarks(benchmark_names, repeat)
+    for scale in scales:
+        params = dict(SCALES[scale], **server_data_kwargs)
+        server_data = generate_server_data(**params)
+        friend_map = FriendMap(deepcopy(server_data))
+        graph = friend_map.get_graph()
+        benchmarks = get_benchmarks(server_data, friend_map)
+        for name, (setup, function) in benchmarks.items():
+            if benchmark_names and name not in benchmark_names:
+                continue
+            __log__.info("running benchmark: scale: {} name: {}".format(
+                scale, name))
+            result = run_benchmark(function, repeat, memory, setup)
+            result.update(
+                {
+                    "scale": scale,
+                    "benchmark": name,
+                    "params": params,
+                    "messages": params["channels"] *
+                                params["messages_per_channel"],
+                    "nodes": graph.number_of_nodes(),
+                    "edges": graph.number_of_edges(),
+                }
+            )
+            __log__.info("finished benchmark: scale: {} name: {} min: {:.4f} "
+                         "peak memory: {}".format(scale, name, result["min"],
+                                                  result["peak_memory"]))
+            results.append(result)
+    return {
+        "version": ".".join(str(part) for part in undiscord.__version__),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.time(),
+        "results": results,
+    }
+
+
+def main(argv=sys.argv[1:]) -> int:
+    """main entry point of the undiscord benchmark suite"""
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    init_logging(args, "undiscord_benchmark.log")
+
+    results = run_benchmarks(
+        args.scales or DEFAULT_SCALES,
+        benchmark_names=args.benchmarks,
+        repeat=args.repeat,
+        memory=args.memory,
+        burstiness=args.burstiness,
+        mention_rate=args.mention_rate,
+        seed=args.seed
+    )
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Generate realistic synthetic server data to benchmark undiscord with"""
+
+from datetime import datetime, timedelta
+from itertools import accumulate
+from random import Random
+from typing import Any, Dict, List
+
+from undiscord.reply_pry import REPLY_TIME
+
+START: datetime = datetime(2019, 1, 12, 12, 0, 0)
+
+
+def generate_server_data(channels: int = 10,
+                         messages_per_channel: int = 1000,
+                         authors: int = 100,
+                         burstiness: float = 0.7,
+                         mention_rate: float = 0.05,
+                         seed: int = 0) -> Dict[str, Any]:
+    """Generate server data shaped like the data collected by the bot
+
+    Authors post with a Zipf-like activity, so that a few authors write most
+    of the messages. Each message follows the previous one within
+    ``REPLY_TIME`` seconds with the probability ``burstiness``, as in a
+    conversation, and otherwise after an exponentially distributed gap.
+    Each message mentions another author with the probability
+    ``mention_rate``.
+    """
+    rand = Random(seed)
+    members = [
+        {"name": "user {}".format(i), "id": str(100000 + i)}
+        for i in range(authors)
+    ]
+    # cumulative weights, so that choosing an author is O(log(authors))
+    activity = list(accumulate(1 / (rank + 1) for rank in range(authors)))
+    return {
+        "name": "synthetic server {}".format(seed),
+        "id": str(seed),
+        "channels": [
+            {
+                "name": "channel {}".format(i),
+                "id": str(200000 + i),
+                "messages": generate_messages(rand, members, activity,
+                                              messages_per_channel,
+                                              burstiness, mention_rate)
+            }
+            for i in range(channels)
+        ]
+    }
+
+
+def generate_messages(rand: Random, members: List[dict], activity: List[float],
+                      messages_number: int, burstiness: float,
+                      mention_rate: float) -> List[dict]:
+    """Generate a channel's messages, ordered newest first"""
+    timestamp = START
+    messages = []
+    for _ in range(messages_number):
+        if rand.random() < burstiness:
+            gap = rand.uniform(1, REPLY_TIME)
+        else:
+            gap = rand.expovariate(1 / 600)
+        timestamp -= timedelta(seconds=round(gap, 6))
+        mentions = []
+        if rand.random() < mention_rate:
+            mentions.append(rand.choice(members))
+        messages.append({
+            "author": rand.choices(members, cum_weights=activity)[0],
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "mentions": mentions
+        })
+    return messages
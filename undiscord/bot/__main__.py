@@ -5,19 +5,38 @@
 
 import argparse
 import asyncio
+import os
+import random
 import sys
+import time
 from logging import getLogger
+from queue import Queue, Empty
+from threading import Thread, Event
+from typing import Awaitable, Callable, Generator, List, Optional
 
 from discord import Client, Server, Channel, Message, Member, Forbidden, \
     NotFound, HTTPException
 
-from undiscord.common import add_log_parser, init_logging
-from undiscord.friend_map import FriendMap, PlotlyAdapter
+from undiscord.common import add_log_parser, init_logging, \
+    DEFAULT_MESSAGES_NUMBER, DEFAULT_TIMEOUT, DEFAULT_CONCURRENCY, \
+    LAYOUT_NAMES, DEFAULT_LAYOUT, MAX_CONCURRENCY, concurrency_number
+from undiscord.message_cache import MessageCache
+from undiscord.message_store import EPOCH
+from undiscord.metrics import METRICS, MESSAGES_SCRAPED, CHANNELS_SKIPPED
 
 __log__ = getLogger(__name__)
 
-DEFAULT_MESSAGES_NUMBER: int = 30
-DEFAULT_TIMEOUT: float = 30.0
+STREAM_QUEUE_SIZE: int = 4
+
+# time allowed past the timeout for the truncated channels to be passed on
+COMPLETION_GRACE: float = 1.0
+
+# fraction of collected messages to log, each message is otherwise only
+# counted in its channel's summary log
+MESSAGE_LOG_SAMPLE: float = 0.0
+
+RETRY_ATTEMPTS: int = 3
+RETRY_DELAY: float = 1.0
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -47,6 +66,34 @@ def get_parser() -> argparse.ArgumentParser:
                         default=DEFAULT_TIMEOUT,
                         help="Time to collect Discord messages before "
                              "stopping")
+    parser.add_argument("-c", "--concurrency", type=concurrency_number,
+                        default=DEFAULT_CONCURRENCY,
+                        help="Number of Discord channels to collect messages "
+                             "from at once, at most {}"
+                             .format(MAX_CONCURRENCY))
+    parser.add_argument("--channel-timeout", dest="channel_timeout",
+                        type=float,
+                        help="Time to collect a Discord channel's messages "
+                             "before truncating it")
+    parser.add_argument("--cache-file", dest="cache_file",
+                        help="Path to a SQLite file to cache collected "
+                             "Discord messages in, so that only new messages "
+                             "are collected")
+    parser.add_argument("-l", "--layout", choices=LAYOUT_NAMES,
+                        default=DEFAULT_LAYOUT,
+                        help="Layout to position the graph's nodes with")
+    parser.add_argument("--shared-plotlyjs", dest="shared_plotlyjs",
+                        action="store_true",
+                        help="Write plotly.js next to the output file to be "
+                             "shared between graphs, rather than embedding "
+                             "it in the output file")
+    parser.add_argument("--positions-file", dest="positions_file",
+                        help="Path to a JSON file of the previous graph's "
+                             "node positions to start the layout from, which "
+                             "is updated with the new positions")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of worker processes to find connections "
+                             "with, defaults to the number of CPUs")
 
     add_log_parser(parser)
 
@@ -59,17 +106,39 @@ def main(argv=sys.argv[1:]) -> int:
 
     args = parser.parse_args(argv)
     init_logging(args, "undiscord_bot.log")
+    global MESSAGE_LOG_SAMPLE  # pylint: disable=global-statement
+    MESSAGE_LOG_SAMPLE = args.log_message_sample
+    # the graph rendering dependencies are slow to import
+    from undiscord.friend_map import FriendMap, PlotlyAdapter, \
+        write_plotlyjs, get_plotlyjs_filename
+    from undiscord.graph_layout import load_positions, save_positions
     with open(args.token_file, "r") as f:
         token = f.read().strip()
-    server_data = scrape_server(
-        token=token,
-        server_name=args.server_name,
-        messages_number=args.message_number,
-        timeout=args.timeout
-    )
-    friend_map = FriendMap(server_data)
-    html_graph = PlotlyAdapter(friend_map, "reingold")
-    html_graph.plot_graph(args.output_file)
+    cache = MessageCache(args.cache_file) if args.cache_file else None
+    server_data = {
+        "name": args.server_name,
+        "channels": stream_server(
+            token=token,
+            server_name=args.server_name,
+            messages_number=args.message_number,
+            timeout=args.timeout,
+            concurrency=args.concurrency,
+            cache=cache,
+            channel_timeout=args.channel_timeout
+        )
+    }
+    friend_map = FriendMap(server_data, workers=args.workers)
+    positions = None
+    if args.positions_file:
+        positions = load_positions(args.positions_file)
+    html_graph = PlotlyAdapter(friend_map, args.layout, positions)
+    if args.positions_file:
+        save_positions(args.positions_file, html_graph.positions)
+    if args.shared_plotlyjs:
+        write_plotlyjs(os.path.dirname(os.path.abspath(args.output_file)))
+        html_graph.plot_graph(args.output_file, get_plotlyjs_filename())
+    else:
+        html_graph.plot_graph(args.output_file)
 
     return 0
 
@@ -77,83 +146,393 @@ def main(argv=sys.argv[1:]) -> int:
 def scrape_server(token: str,
                   server_name: str,
                   messages_number: int = DEFAULT_MESSAGES_NUMBER,
-                  timeout: float = DEFAULT_TIMEOUT):
+                  timeout: float = DEFAULT_TIMEOUT,
+                  concurrency: int = DEFAULT_CONCURRENCY,
+                  cache: Optional[MessageCache] = None,
+                  channel_timeout: Optional[float] = None):
+    """Collect the messages of the Discord server
+
+    Returns as soon as every channel is collected, or the server is not
+    found, with at most ``timeout`` seconds spent collecting. Channels whose
+    collection ran out of time are listed under ``"truncated_channels"``.
+    """
+    collector = ServerDataCollector()
+    run_client(token, timeout, messages_number, server_name,
+               collector.add_server, collector.add_channel, full_messages=True,
+               concurrency=concurrency, cache=cache,
+               channel_timeout=channel_timeout)
+    return collector.server_data
+
+
+class ServerDataCollector:
+    """Gather the server and channels passed by :func:`collect_server` into
+    a ``server_data`` dict"""
+
+    def __init__(self):
+        self.server_data = {}
+
+    def add_server(self, server: Server):
+        self.server_data.update(
+            {
+                "name": server.name,
+                "id": server.id,
+                "channels": [],
+                "truncated_channels": []
+            }
+        )
+
+    async def add_channel(self, channel_data: dict):
+        self.server_data["channels"].append(channel_data)
+        if channel_data["truncated"]:
+            self.server_data["truncated_channels"].append(channel_data["id"])
+
+
+def stream_server(token: str,
+                  server_name: str,
+                  messages_number: int = DEFAULT_MESSAGES_NUMBER,
+                  timeout: float = DEFAULT_TIMEOUT,
+                  concurrency: int = DEFAULT_CONCURRENCY,
+                  cache: Optional[MessageCache] = None,
+                  channel_timeout: Optional[float] = None) -> Generator[
+                      dict, None, None]:
+    """Yield the channels of the Discord server as their messages are
+    collected
+
+    Unlike :func:`scrape_server` the message records only hold what the
+    analysis in :mod:`undiscord.reply_pry` needs, and at most
+    :data:`STREAM_QUEUE_SIZE` collected channels are held waiting for the
+    consumer, with up to ``concurrency`` more being collected or waiting to
+    be queued.
+    """
+    channels = Queue(maxsize=STREAM_QUEUE_SIZE)
+    stopped = Event()
+    errors = []
+
+    async def add_channel(channel_data: dict):
+        if not stopped.is_set():
+            await asyncio.get_event_loop().run_in_executor(
+                None, channels.put, channel_data)
+
+    def run():
+        try:
+            run_client(token, timeout, messages_number, server_name,
+                       lambda server: None, add_channel, full_messages=False,
+                       concurrency=concurrency, cache=cache,
+                       channel_timeout=channel_timeout)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+        finally:
+            channels.put(None)
+
+    thread = Thread(target=run, name="stream_server", daemon=True)
+    thread.start()
+    try:
+        for channel_data in iter(channels.get, None):
+            yield channel_data
+    finally:
+        # unblock the collecting thread if the consumer stopped early
+        stopped.set()
+        while thread.is_alive():
+            try:
+                channels.get(timeout=0.1)
+            except Empty:
+                pass
+    if errors:
+        raise errors[0]
+
+
+def run_client(token: str, timeout: float, messages_number: int,
+               server_name: str, add_server: Callable[[Server], None],
+               add_channel: Callable[[dict], Awaitable[None]],
+               full_messages: bool = True,
+               concurrency: int = DEFAULT_CONCURRENCY,
+               cache: Optional[MessageCache] = None,
+               channel_timeout: Optional[float] = None):
+    """Log into Discord and collect the messages of the named server
+
+    The client is logged out as soon as the collection completes, rather
+    than waiting out the ``timeout``. Time spent waiting on ``add_channel``
+    is not counted against the ``timeout``, so that a slow consumer of the
+    collected channels does not cause them to be dropped.
+    """
     loop = asyncio.new_event_loop()
     client = Client(is_bot=False, loop=loop, max_messages=messages_number)
-    server_data = {}
+    completed = loop.create_future()
+    start = loop.time()
+    deadline = start + timeout
+    blocked = {"waiting": 0, "since": 0.0, "total": 0.0}
+
+    async def deliver_channel(channel_data: dict):
+        if not blocked["waiting"]:
+            blocked["since"] = loop.time()
+        blocked["waiting"] += 1
+        try:
+            await add_channel(channel_data)
+        finally:
+            blocked["waiting"] -= 1
+            if not blocked["waiting"]:
+                blocked["total"] += loop.time() - blocked["since"]
+
+    def get_blocked_time() -> float:
+        if blocked["waiting"]:
+            return blocked["total"] + loop.time() - blocked["since"]
+        return blocked["total"]
 
     @client.event
     async def on_ready():
-        __log__.info("logged in as: {}".format(client.user.id))
-
-        for server in client.servers:
-            if server.name != server_name:
-                continue
-            server: Server = server
-            __log__.info("obtained server: name: {} id: {}".format(
-                server.name, server.id))
-            server_data.update(
-                {
-                    "name": server.name,
-                    "id": server.id,
-                    "channels": []
-                }
-            )
-
-            for channel in server.channels:
-                channel: Channel = channel
-                __log__.info("obtained channel: name: {} id: {}".format(
-                    channel.name, channel.id))
-                channel_data = {
-                    "name": channel.name,
-                    "id": channel.id,
-                    "messages": []
-                }
-
-                try:
-                    async for message in client.logs_from(channel,
-                                                          limit=messages_number):
-                        message: Message = message
-                        __log__.info(
-                            "obtained message: author: {} content: {}".format(
-                                message.author.id, message.content))
-                        author: Member = message.author
-                        message_data = {
-                            "author": {
-                                "name": author.name,
-                                "id": author.id
-                            },
-                            "server": message.server.name,
-                            "channel": message.channel.name,
-                            "timestamp": str(message.timestamp),
-                            "content": message.content,
-                            "mentions": [
-                                dict(
-                                    name=mentioned_member.name,
-                                    id=mentioned_member.id
-                                )
-                                for mentioned_member in message.mentions
-                            ]
-                        }
-                        channel_data["messages"].append(message_data)
-                except Forbidden:  # cant access channel
-                    pass
-                except NotFound:  # cant find channel
-                    pass
-                except HTTPException:  # discord likely down
-                    pass
-                server_data["channels"].append(channel_data)
-        client.close()
+        __log__.info("logged in as: %s", client.user.id)
+        # logging in lasts until the gateway handshake is ready
+        METRICS.record("login", loop.time() - start)
+        try:
+            with METRICS.time("fetch"):
+                await collect_server(client, server_name, messages_number,
+                                     add_server, deliver_channel,
+                                     full_messages,
+                                     concurrency, cache, deadline=deadline,
+                                     channel_timeout=channel_timeout,
+                                     get_blocked_time=get_blocked_time)
+        finally:
+            if not completed.done():
+                completed.set_result(None)
 
     loop.run_until_complete(client.login(token, bot=False))
-    try:
-        loop.run_until_complete(
-            asyncio.wait_for(client.connect(), timeout, loop=loop))
-    except asyncio.TimeoutError:
-        pass
+    connection = loop.create_task(client.connect())
+    while not completed.done() and not connection.done():
+        remaining = deadline + get_blocked_time() + COMPLETION_GRACE - \
+            loop.time()
+        if remaining <= 0:
+            break
+        loop.run_until_complete(asyncio.wait(
+            [connection, completed], loop=loop, timeout=remaining,
+            return_when=asyncio.FIRST_COMPLETED
+        ))
+    if not completed.done():
+        __log__.warning("collection did not complete: server: %s",
+                        server_name)
     loop.run_until_complete(client.logout())
+    connection.cancel()
+    loop.run_until_complete(asyncio.wait([connection], loop=loop))
     loop.close()
-    return server_data
+
+
+async def collect_server(client: Client, server_name: str,
+                         messages_number: int,
+                         add_server: Callable[[Server], None],
+                         add_channel: Callable[[dict], Awaitable[None]],
+                         full_messages: bool = True,
+                         concurrency: int = DEFAULT_CONCURRENCY,
+                         cache: Optional[MessageCache] = None,
+                         deadline: Optional[float] = None,
+                         channel_timeout: Optional[float] = None,
+                         get_blocked_time: Callable[[], float] = lambda: 0.0
+                         ) -> bool:
+    """Collect the message history of every channel in the named server,
+    returning whether the server was found
+
+    Up to ``concurrency`` channels are fetched at once, with each channel
+    passed to ``add_channel`` as soon as it is collected and before its
+    place is given to the next channel, so that a slow ``add_channel``
+    holds back the collection rather than collected channels piling up. A
+    channel is collected for at most ``channel_timeout`` seconds and until
+    the event loop time ``deadline``, extended by the seconds
+    ``get_blocked_time`` reports were spent waiting on ``add_channel``,
+    after which it is passed on truncated.
+
+    If a ``cache`` is given only the messages newer than a channel's newest
+    cached message are fetched from Discord, and are merged with and added
+    to the cached messages. Cached messages are only passed on for channels
+    whose fetch completed, as they were possibly cached with another token
+    that could read the channel.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def collect(server: Server, channel: Channel):
+        cached_messages = []
+        if cache is not None:
+            cached_messages = cache.get_messages(server.id, channel.id,
+                                                 messages_number,
+                                                 full_messages)
+        async with semaphore:
+            timeout = channel_timeout
+            if deadline is not None:
+                remaining = deadline + get_blocked_time() - loop.time()
+                timeout = remaining if timeout is None \
+                    else min(timeout, remaining)
+            channel_data = await collect_channel(
+                client, channel, messages_number, full_messages,
+                cached_messages[0]["id"] if cached_messages else None,
+                timeout)
+            # a truncated channel may leave a gap before the cached messages,
+            # and a skipped channel's cached messages may not be readable
+            if cache is not None and not channel_data["truncated"] and \
+                    not channel_data["skipped"]:
+                cache.add_messages(server.id, channel.id,
+                                   channel_data["messages"])
+                __log__.info("merged cached messages: channel: %s new: %d "
+                             "cached: %d", channel.id,
+                             len(channel_data["messages"]),
+                             len(cached_messages))
+                channel_data["messages"] = (channel_data["messages"] +
+                                            cached_messages)[:messages_number]
+            await add_channel(channel_data)
+
+    for server in client.servers:
+        if server.name != server_name:
+            continue
+        server: Server = server
+        __log__.info("obtained server: name: %s id: %s", server.name,
+                     server.id)
+        add_server(server)
+        await asyncio.gather(*[collect(server, channel)
+                               for channel in server.channels])
+        return True
+    __log__.warning("server not found: name: %s", server_name)
+    return False
+
+
+async def collect_channel(client: Client, channel: Channel,
+                          messages_number: int,
+                          full_messages: bool = True,
+                          last_message_id: Optional[str] = None,
+                          timeout: Optional[float] = None) -> dict:
+    """Collect the message history of the channel, newest first, stopping
+    at the already collected ``last_message_id``
+
+    Rate limited or failed requests are retried, resuming from the oldest
+    collected message, with an exponential backoff. If the ``timeout``
+    runs out, or the retries do, the messages collected so far are kept and
+    the channel is marked as ``"truncated"``. Channels that cannot be read
+    are marked as ``"skipped"``.
+    """
+    channel: Channel = channel
+    __log__.debug("obtained channel: name: %s id: %s", channel.name,
+                  channel.id)
+    start = time.monotonic()
+    channel_data = {
+        "name": channel.name,
+        "id": channel.id,
+        "messages": [],
+        "truncated": False,
+        "skipped": False
+    }
+    try:
+        skipped_reason = await asyncio.wait_for(
+            fetch_channel_messages(client, channel, channel_data["messages"],
+                                   messages_number, full_messages,
+                                   last_message_id),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        __log__.warning("truncated channel: name: %s id: %s messages: %d",
+                        channel.name, channel.id,
+                        len(channel_data["messages"]))
+        channel_data["truncated"] = True
+    else:
+        if skipped_reason == "HTTPException":
+            channel_data["truncated"] = True
+        elif skipped_reason is not None:
+            channel_data["skipped"] = True
+    METRICS.inc(MESSAGES_SCRAPED, len(channel_data["messages"]))
+    __log__.info("collected channel: name: %s id: %s messages: %d "
+                 "truncated: %s time: %.3f", channel.name, channel.id,
+                 len(channel_data["messages"]), channel_data["truncated"],
+                 time.monotonic() - start)
+    return channel_data
+
+
+async def fetch_channel_messages(client: Client, channel: Channel,
+                                 messages: List[dict], messages_number: int,
+                                 full_messages: bool = True,
+                                 last_message_id: Optional[str] = None
+                                 ) -> Optional[str]:
+    """Append the channel's messages, returning the reason the channel was
+    skipped if the fetch stopped early"""
+    before = None
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        try:
+            async for message in client.logs_from(
+                    channel,
+                    limit=messages_number - len(messages),
+                    before=before):
+                message: Message = message
+                if last_message_id is not None and \
+                        int(message.id) <= int(last_message_id):
+                    break
+                if MESSAGE_LOG_SAMPLE and random.random() < MESSAGE_LOG_SAMPLE:
+                    __log__.info("sampled message: author: %s content: %s",
+                                 message.author.id, message.content)
+                messages.append(get_message_data(message, full_messages))
+                before = message
+            return None
+        except Forbidden:  # cant access channel
+            __log__.info("skipped channel: name: %s id: %s reason: Forbidden",
+                         channel.name, channel.id)
+            METRICS.inc(CHANNELS_SKIPPED, reason="Forbidden")
+            return "Forbidden"
+        except NotFound:  # cant find channel
+            __log__.info("skipped channel: name: %s id: %s reason: NotFound",
+                         channel.name, channel.id)
+            METRICS.inc(CHANNELS_SKIPPED, reason="NotFound")
+            return "NotFound"
+        except HTTPException as e:  # rate limited or discord likely down
+            status = getattr(e.response, "status", None)
+            if attempt == RETRY_ATTEMPTS or \
+                    status != 429 and (status or 0) < 500:
+                __log__.warning("skipped channel: name: %s id: %s reason: "
+                                "HTTPException status: %s", channel.name,
+                                channel.id, status)
+                METRICS.inc(CHANNELS_SKIPPED, reason="HTTPException")
+                return "HTTPException"
+            delay = get_retry_delay(e, attempt)
+            __log__.warning("retrying channel: name: %s id: %s status: %s "
+                            "in %ss", channel.name, channel.id, status, delay)
+            await asyncio.sleep(delay)
+
+
+def get_retry_delay(error: HTTPException, attempt: int) -> float:
+    """Return the seconds to wait before retrying a failed request, which is
+    the response's ``Retry-After`` if given or an exponential backoff"""
+    headers = getattr(error.response, "headers", None) or {}
+    try:
+        return max(float(headers["Retry-After"]), 0.0)
+    except (KeyError, TypeError, ValueError):
+        return RETRY_DELAY * 2 ** attempt
+
+
+def get_message_data(message: Message, full_message: bool = True) -> dict:
+    """Convert a Discord message into a message record
+
+    If not ``full_message`` the server, channel, and content fields are
+    dropped and the timestamp is also stored as epoch seconds.
+    """
+    author: Member = message.author
+    message_data = {
+        "id": message.id,
+        "author": {
+            "name": author.name,
+            "id": author.id
+        },
+        "timestamp": str(message.timestamp),
+        "mentions": [
+            dict(
+                name=mentioned_member.name,
+                id=mentioned_member.id
+            )
+            for mentioned_member in message.mentions
+        ]
+    }
+    if full_message:
+        message_data.update(
+            {
+                "server": message.server.name,
+                "channel": message.channel.name,
+                "content": message.content,
+            }
+        )
+    else:
+        message_data["epoch"] = (message.timestamp - EPOCH).total_seconds()
+    return message_data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""Long lived Discord client sessions shared between scrapes"""
+
+import asyncio
+import time
+from logging import getLogger
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from discord import Client
+
+from undiscord.bot.__main__ import collect_server, ServerDataCollector
+from undiscord.common import DEFAULT_MESSAGES_NUMBER, DEFAULT_TIMEOUT, \
+    DEFAULT_CONCURRENCY, DEFAULT_IDLE_TIMEOUT, get_token_scope
+from undiscord.message_cache import MessageCache
+from undiscord.metrics import METRICS
+
+__log__ = getLogger(__name__)
+
+
+class Session:
+    """A logged in Discord client and its connection task"""
+
+    def __init__(self, client: Client, connection: asyncio.Task):
+        self.client = client
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.users = 0
+
+    def is_alive(self) -> bool:
+        return not self.connection.done() and not self.client.is_closed
+
+
+class ClientManager:
+    """Keep Discord clients logged in on a background event loop thread
+
+    A session is kept per token, so that repeated scrapes skip the login and
+    gateway handshake, and is logged out after ``idle_timeout`` seconds
+    without use. Sessions are keyed by the token's scope digest rather than
+    the token itself. Scrapes from other threads are run on the manager's event
+    loop with :func:`asyncio.run_coroutine_threadsafe`.
+    """
+
+    def __init__(self, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 client_factory: Callable[..., Client] = Client):
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory
+        self.logins = 0
+        self.logins_avoided = 0
+        self.evictions = 0
+        self.loop = asyncio.new_event_loop()
+        self._sessions = {}  # type: Dict[str, Session]
+        # locks of the pending logins and the number of their users
+        self._login_locks = {}  # type: Dict[str, asyncio.Lock]
+        self._login_waiters = {}  # type: Dict[str, int]
+        self._thread = Thread(target=self._run, name="ClientManager",
+                              daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close_sessions(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._sessions),
+            "logins": self.logins,
+            "logins_avoided": self.logins_avoided,
+            "evictions": self.evictions,
+        }
+
+    def scrape_server(self, token: str,
+                      server_name: str,
+                      messages_number: int = DEFAULT_MESSAGES_NUMBER,
+                      timeout: float = DEFAULT_TIMEOUT,
+                      concurrency: int = DEFAULT_CONCURRENCY,
+                      cache: Optional[MessageCache] = None,
+                      channel_timeout: Optional[float] = None) -> dict:
+        """Scrape the server like :func:`undiscord.bot.__main__.scrape_server`
+        but with the token's long lived session"""
+        server_data, timings = asyncio.run_coroutine_threadsafe(
+            self._scrape_server(token, server_name, messages_number, timeout,
+                                concurrency, cache, channel_timeout),
+            self.loop
+        ).result()
+        # the stages are recorded on the calling thread, so that they are
+        # part of its timings
+        for stage, duration in timings:
+            METRICS.record(stage, duration)
+        return server_data
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._evict_idle_sessions())
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _scrape_server(self, token: str, server_name: str,
+                             messages_number: int, timeout: float,
+                             concurrency: int,
+                             cache: Optional[MessageCache],
+                             channel_timeout: Optional[float]) -> Tuple[
+                                 dict, List[Tuple[str, float]]]:
+        """Scrape the server, returning its data and the ``(stage, seconds)``
+        timings of the scrape"""
+        collector = ServerDataCollector()
+        timings = []  # type: List[Tuple[str, float]]
+        deadline = self.loop.time() + timeout
+        session = await asyncio.wait_for(self._get_session(token, timings),
+                                         timeout)
+        session.users += 1
+        start = self.loop.time()
+        try:
+            await collect_server(session.client, server_name,
+                                 messages_number, collector.add_server,
+                                 collector.add_channel, True, concurrency,
+                                 cache, deadline=deadline,
+                                 channel_timeout=channel_timeout)
+        finally:
+            session.users -= 1
+            session.last_used = time.monotonic()
+            timings.append(("fetch", self.loop.time() - start))
+        return collector.server_data, timings
+
+    async def _get_session(self, token: str,
+                           timings: List[Tuple[str, float]]) -> Session:
+        scope = get_token_scope(token)
+        lock = self._login_locks.setdefault(scope, asyncio.Lock())
+        self._login_waiters[scope] = self._login_waiters.get(scope, 0) + 1
+        try:
+            async with lock:
+                return await self._login(token, scope, timings)
+        finally:
+            # the lock is only kept while logins of the token are pending
+            self._login_waiters[scope] -= 1
+            if not self._login_waiters[scope]:
+                del self._login_waiters[scope]
+                del self._login_locks[scope]
+
+    async def _login(self, token: str, scope: str,
+                     timings: List[Tuple[str, float]]) -> Session:
+        """Return the token's live session, logging in a new one if needed
+        and appending the time it took to ``timings``"""
+        session = self._sessions.get(scope)
+        if session is not None:
+            if session.is_alive():
+                self.logins_avoided += 1
+                return session
+            # log out the dead session's client before replacing it
+            await self._close_session(scope)
+
+        start = self.loop.time()
+        client = self.client_factory(is_bot=False, loop=self.loop)
+        await client.login(token, bot=False)
+        self.logins += 1
+        connection = self.loop.create_task(client.connect())
+        ready = self.loop.create_task(client.wait_until_ready())
+        try:
+            await asyncio.wait([connection, ready],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if connection.done():
+                raise ConnectionError(
+                    "Discord connection closed before it was ready")
+        except BaseException:
+            ready.cancel()
+            connection.cancel()
+            self.loop.create_task(client.logout())
+            raise
+        __log__.info("logged in session as: {}".format(client.user.id))
+        timings.append(("login", self.loop.time() - start))
+        session = self._sessions[scope] = Session(client, connection)
+        return session
+
+    async def _evict_idle_sessions(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+            now = time.monotonic()
+            for scope, session in list(self._sessions.items()):
+                if session.users:
+                    continue
+                if session.is_alive() and \
+                        now - session.last_used < self.idle_timeout:
+                    continue
+                self.evictions += 1
+                await self._close_session(scope)
+
+    async def _close_sessions(self):
+        for scope in list(self._sessions):
+            await self._close_session(scope)
+
+    async def _close_session(self, scope: str):
+        session = self._sessions.pop(scope)
+        __log__.info("logging out session as: {}".format(
+            session.client.user.id))
+        try:
+            await session.client.logout()
+        finally:
+            session.connection.cancel()
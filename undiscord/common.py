@@ -3,13 +3,34 @@
 """Common functionality between the Discord bot and server"""
 
 import argparse
+import atexit
+import hashlib
 import logging
 import os
 import sys
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, \
+    QueueListener
+from queue import Queue
+from typing import List, Optional
 
 LOG_LEVEL_STRINGS = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
 
+# defaults shared by the bot and server, kept here so that reading them does
+# not import discord.py or the graph rendering dependencies
+DEFAULT_MESSAGES_NUMBER: int = 30
+DEFAULT_TIMEOUT: float = 30.0
+
+DEFAULT_CONCURRENCY: int = 4
+# channels fetched at once are clamped to this, to stay clear of Discord's
+# rate limits
+MAX_CONCURRENCY: int = 16
+
+DEFAULT_IDLE_TIMEOUT: float = 600.0
+
+# names of :data:`undiscord.friend_map.layouts`
+LAYOUT_NAMES: List[str] = ["auto", "grid", "random", "reingold", "spectral"]
+DEFAULT_LAYOUT: str = "auto"
+
 
 def log_level(log_level_string: str):
     """Argparse type function for determining the specified logging level"""
@@ -23,6 +44,26 @@ def log_level(log_level_string: str):
     return getattr(logging, log_level_string, logging.INFO)
 
 
+def concurrency_number(concurrency_string: str) -> int:
+    """Argparse type function for the number of Discord channels to collect
+    messages from at once, clamped to ``MAX_CONCURRENCY``"""
+    try:
+        value = int(concurrency_string)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError(
+            "invalid int value: {}".format(concurrency_string))
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "concurrency must be at least 1: {}".format(value))
+    return min(value, MAX_CONCURRENCY)
+
+
+def get_token_scope(token: str) -> str:
+    """Return a digest of the Discord token, as different tokens can access
+    different channels"""
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()
+
+
 def add_log_parser(parser):
     """Add logging options to the argument parser"""
     group = parser.add_argument_group(title="Logging")
@@ -33,10 +74,23 @@ def add_log_parser(parser):
                             "specified")
     group.add_argument("-v", "--verbose", action="store_true",
                        help="Enable verbose logging")
+    group.add_argument("--async-logging", dest="async_logging",
+                       action="store_true",
+                       help="Write logs from a background thread, so that "
+                            "logging does not block on file or stream I/O")
+    group.add_argument("--log-message-sample", dest="log_message_sample",
+                       type=float, default=0.0,
+                       help="Fraction of collected Discord messages to log, "
+                            "channels are otherwise only logged as summaries")
+
 
+def init_logging(args, log_file_path) -> Optional[QueueListener]:
+    """Intake a argparse.parse_args() object and setup python logging
 
-def init_logging(args, log_file_path):
-    """Intake a argparse.parse_args() object and setup python logging"""
+    With ``args.async_logging`` records are put on a queue and written by
+    the handlers from a :class:`QueueListener` thread, which is returned and
+    is stopped, flushing the queue, at exit.
+    """
     # configure logging
     handlers_ = []
     log_format = logging.Formatter(fmt="[%(asctime)s] [%(levelname)s] - %(message)s")
@@ -55,7 +109,17 @@ def init_logging(args, log_file_path):
         stream_handler.setLevel(args.log_level)
         handlers_.append(stream_handler)
 
+    listener = None
+    if getattr(args, "async_logging", False) and handlers_:
+        log_queue = Queue()
+        listener = QueueListener(log_queue, *handlers_,
+                                 respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers_ = [QueueHandler(log_queue)]
+
     logging.basicConfig(
         handlers=handlers_,
         level=args.log_level
     )
+    return listener
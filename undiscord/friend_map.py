@@ -2,24 +2,57 @@
 
 """Generate a network graph from connection data"""
 
+import json
+import os
+import tempfile
+from collections import Counter
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple, List, Iterable, \
+    TYPE_CHECKING
 
-import matplotlib.pyplot as plt
-import networkx as nx
-import plotly
-import plotly.graph_objs as go
+from undiscord.graph_layout import auto_layout, grid_layout, \
+    random_layout, reingold_layout, spectral_layout, Positions
+from undiscord.message_store import ServerStore
+from undiscord.metrics import METRICS
+from undiscord.reply_pry import get_connection_counts_from_server, \
+    get_channel_tail, get_new_connections_from_channel, get_message_epoch, \
+    Message, ProcessPool
 
-from undiscord.reply_pry import get_connections_from_server
+# networkx, matplotlib and plotly are slow to import, so they are only
+# imported by the functions that use them
+if TYPE_CHECKING:  # pragma: no cover
+    import networkx as nx
 
 
-def reingold(G):
-    return nx.fruchterman_reingold_layout(G, k=0.25)
+def get_plotlyjs_filename() -> str:
+    """Return the file name of the shared plotly.js asset, versioned so that
+    it can be cached indefinitely"""
+    import plotly
+    return "plotly-{}.min.js".format(plotly.__version__)
 
 
+def write_plotlyjs(directory: str) -> str:
+    """Write the shared plotly.js asset into the directory, if it is not
+    already there, and return its path"""
+    import plotly.offline
+    path = os.path.join(directory, get_plotlyjs_filename())
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        # concurrent first graphs each write their own temporary file
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory,
+                                         suffix=".tmp", delete=False) as f:
+            f.write(plotly.offline.get_plotlyjs())
+        os.replace(f.name, path)
+    return path
+
+
+# layouts called with the graph and optionally its previous node positions
 layouts: dict = {
-    "reingold": reingold,
-    "random": nx.random_layout
+    "auto": auto_layout,
+    "reingold": reingold_layout,
+    "random": random_layout,
+    "grid": grid_layout,
+    "spectral": spectral_layout
 }
 
 
@@ -27,23 +60,108 @@ class FriendMap:
     """Factory for creating directed network graphs representing conversations
     between Discord server members"""
 
-    def __init__(self, server_data: dict):
+    def __init__(self, server_data: dict, workers: Optional[int] = None,
+                 executor: Optional[ProcessPool] = None):
+        import networkx as nx
         self.graph = nx.DiGraph()
+        # newest messages of each channel that an update can connect to
+        self.channel_tails = {}  # type: Dict[str, List[Message]]
         self.graph_title = "{} {} Network graph".format(
             datetime.utcnow().strftime("%Y-%m-%d"),
-            server_data['name']
+            server_data.name if isinstance(server_data, ServerStore)
+            else server_data['name']
         )
-        self.add_nodes(server_data)
-        self.add_connections(server_data)
+        if isinstance(server_data, ServerStore):
+            self.add_server_store(server_data)
+        elif isinstance(server_data["channels"], list):
+            self.add_nodes(server_data)
+            for channel in server_data["channels"]:
+                self.set_channel_tail(channel["id"], channel["messages"])
+            self.add_connections(server_data, workers, executor)
+        else:
+            # streamed channels can only be iterated once
+            self.add_connections(
+                {"channels": self.add_channels(server_data["channels"])},
+                workers, executor)
+
+    def add_channels(self, channels: Iterable[Dict[str, Any]]):
+        """Add each channel's authors and tail while passing the channel
+        through"""
+        for channel in channels:
+            self.add_nodes({"channels": [channel]})
+            self.set_channel_tail(channel["id"], channel["messages"])
+            yield channel
+
+    def add_server_store(self, server_store: ServerStore):
+        import numpy as np
+        names = server_store.authors.names
+        for channel in server_store.channels:
+            # order the authors by their first message like add_nodes
+            authors, first_messages = np.unique(channel.authors,
+                                                return_index=True)
+            self.graph.add_nodes_from(
+                names[author]
+                for author in authors[np.argsort(first_messages)].tolist())
+            self.set_channel_tail(channel.id,
+                                  channel.iter_messages(server_store.authors))
+        self.add_connections(server_store)
+
+    def update(self, new_server_data: Dict[str, Any]):
+        """Update the graph in place with newly collected messages
+
+        Only messages newer than the last processed message of their channel
+        are added, connecting to the processed messages still within reply
+        time.
+        """
+        if isinstance(new_server_data, ServerStore):
+            channels = (
+                channel.to_channel_data(new_server_data.authors)
+                for channel in new_server_data.channels
+            )  # type: Iterable[Dict[str, Any]]
+        else:
+            channels = new_server_data["channels"]
 
-    def add_connections(self, server_data: Dict[str, Any]):
-        for orig_author, reply_author in get_connections_from_server(server_data):
-            if self.graph.has_edge(orig_author, reply_author):
-                self.graph[orig_author][reply_author]['weight'] += 1
-            else:
-                self.graph.add_edge(orig_author, reply_author, weight=1)
+        connection_counts = Counter()
+        for channel in channels:
+            tail = self.channel_tails.get(channel["id"], [])
+            new_messages = channel["messages"]
+            if tail:
+                last_epoch = get_message_epoch(tail[0])
+                new_messages = [message for message in new_messages
+                                if get_message_epoch(message) > last_epoch]
+            if not new_messages:
+                continue
+            self.add_nodes({"channels": [{"messages": new_messages}]})
+            connection_counts.update(
+                get_new_connections_from_channel(new_messages, tail))
+            self.set_channel_tail(channel["id"], new_messages + tail)
+        self.add_connection_counts(connection_counts)
+
+    def set_channel_tail(self, channel_id: str, messages: Iterable[Message]):
+        tail = get_channel_tail(messages)
+        if tail:
+            self.channel_tails[channel_id] = tail
+
+    def add_connections(self, server_data: Dict[str, Any],
+                        workers: Optional[int] = None,
+                        executor: Optional[ProcessPool] = None):
+        connection_counts = get_connection_counts_from_server(
+            server_data, workers, executor)
+        self.add_connection_counts(connection_counts)
+
+    def add_connection_counts(self, connection_counts: Dict[Tuple[str, str], int]):
+        """Add the counted connections to the graph with a single update,
+        so that building the graph scales with the number of unique edges"""
+        self.graph.add_weighted_edges_from([
+            (orig_author, reply_author,
+             count + self.graph.get_edge_data(orig_author, reply_author,
+                                              default={}).get('weight', 0))
+            for (orig_author, reply_author), count in connection_counts.items()
+        ])
 
     def plot(self, filename: str):
+        import matplotlib.pyplot as plt
+        import networkx as nx
         nx.spring_layout(self.graph)
         nx.draw_networkx(self.graph)
         plt.axis('off')
@@ -58,28 +176,66 @@ class FriendMap:
         return self.graph
 
     def add_nodes(self, server_data):
-        for channel in server_data["channels"]:
-            for message in channel["messages"]:
-                self.graph.add_node(message["author"]["name"])
+        # dict.fromkeys deduplicates the authors while keeping their order
+        self.graph.add_nodes_from(dict.fromkeys(
+            message["author"]["name"]
+            for channel in server_data["channels"]
+            for message in channel["messages"]
+        ))
+
+
+# edge colours ordered by increasing connection weight
+LINE_COLORS: List[str] = ['#ff0000', '#ffbf00', '#80ff00', '#00ff40', '#00ffff',
+                          '#0040ff', '#8000ff']
 
 
 class PlotlyAdapter:
-    """Adapter to convert a FriendMap into a plotly map"""
+    """Adapter to convert a FriendMap into a plotly map
+
+    The layout is warm started from the ``positions`` of a previous graph of
+    the server if they are given, and the computed node positions are kept
+    as :attr:`positions` to warm start the next graph with.
+    """
 
-    def __init__(self, friend_map: FriendMap, layout: str):
+    def __init__(self, friend_map: FriendMap, layout: str,
+                 positions: Optional[Positions] = None):
         self.title = friend_map.get_title()
-        self.edge_trace = []
-        self.node_trace = go.Scatter(
-            x=[],
-            y=[],
-            text=[],
+        graph = friend_map.get_graph()
+        with METRICS.time("layout"):
+            self.positions = layouts[layout](graph, positions)
+        self.edge_trace = self.get_edge_traces(graph, self.positions)
+        self.node_trace = self.get_node_trace(graph, self.positions)
+
+    @staticmethod
+    def get_node_trace(graph: "nx.Graph", positions) -> "go.Scatter":
+        """Build the trace of every node in one pass, so that plotly only
+        validates the finished arrays"""
+        import plotly.graph_objs as go
+        xs = []
+        ys = []
+        texts = []
+        colors = []
+        for node, adjacencies in graph.adjacency():
+            x, y = positions[node]
+            xs.append(x)
+            ys.append(y)
+            colors.append(len(adjacencies))
+            texts.append(
+                node + "<br>" +
+                "Connections (" + str(len(adjacencies)) + "):<br>" +
+                "".join("   " + adj + "<br> " for adj in adjacencies)
+            )
+        return go.Scatter(
+            x=xs,
+            y=ys,
+            text=texts,
             mode='markers',
             hoverinfo='text',
             marker=dict(
                 showscale=True,
                 colorscale='Rainbow',
                 reversescale=True,
-                color=[],
+                color=colors,
                 size=10,
                 colorbar=dict(
                     thickness=15,
@@ -91,49 +247,55 @@ class PlotlyAdapter:
             )
         )
 
-        positions = layouts[layout](friend_map.get_graph())
-        self.set_nodes(friend_map.get_graph(), positions)
-        self.set_edges(friend_map.get_graph(), positions)
-        self.set_node_attributes(friend_map.get_graph())
-
-    def set_nodes(self, graph: nx.Graph, positions):
-        for node in graph.nodes():
-            x, y = positions[node]
-            self.node_trace['x'] += tuple([x])
-            self.node_trace['y'] += tuple([y])
-
-    def set_edges(self, graph: nx.Graph, positions):
-        for edge in graph.edges():
-            x0, y0 = positions[edge[0]]
-            x1, y1 = positions[edge[1]]
-            edge_trace = go.Scatter(
-                x=[x0, x1, None],
-                y=[y0, y1, None],
-                line=dict(width=2, color=self.get_line_color(graph[edge[0]][edge[1]]['weight'])),
+    @classmethod
+    def get_edge_traces(cls, graph: "nx.Graph",
+                        positions) -> List["go.Scatter"]:
+        """Build one trace per edge colour, with each edge's line segment
+        separated from the next by ``None``"""
+        import plotly.graph_objs as go
+        segments = {}  # type: Dict[str, Tuple[list, list]]
+        for node0, node1, weight in graph.edges(data="weight"):
+            x0, y0 = positions[node0]
+            x1, y1 = positions[node1]
+            xs, ys = segments.setdefault(cls.get_line_color(weight), ([], []))
+            xs.extend((x0, x1, None))
+            ys.extend((y0, y1, None))
+        return [
+            go.Scatter(
+                x=xs,
+                y=ys,
+                line=dict(width=2, color=color),
                 hoverinfo='none',
                 mode='lines')
-            self.edge_trace.append(edge_trace)
-
-    def set_node_attributes(self, graph: nx.Graph):
-        for node, adjacencies in enumerate(graph.adjacency()):
-            self.node_trace['marker']['color'] += tuple([len(adjacencies[1])])
+            # draw the heavier edges over the lighter ones
+            for color, (xs, ys) in sorted(
+                segments.items(), key=lambda item: LINE_COLORS.index(item[0]))
+        ]
 
-        for node, adjacencies in enumerate(graph.adjacency()):
-            node_info = adjacencies[0] + "<br>"
-            node_info += 'Connections (' + str(len(adjacencies[1])) + "):<br>"
-            for adj in adjacencies[1]:
-                node_info += "   " + adj + "<br> "
-            self.node_trace['text'] += tuple([node_info])
-
-    def plot_graph(self, filename: str):
-        plotly.offline.plot(self.get_figure(), filename=filename, auto_open=False)
-        pass
+    def plot_graph(self, filename: str, plotlyjs_src: Optional[str] = None):
+        """Write the graph to a HTML file, which embeds plotly.js unless the
+        ``plotlyjs_src`` of a shared plotly.js asset is given"""
+        import plotly.offline
+        if plotlyjs_src is None:
+            plotly.offline.plot(self.get_figure(), filename=filename, auto_open=False)
+        else:
+            with open(filename, "w", encoding="utf-8") as f:
+                f.write(self.get_html(plotlyjs_src))
 
-    def get_html(self):
-        return "<html><head>  <script src='https://cdn.plot.ly/plotly-latest.min.js'></script></head><body>" \
+    def get_html(self, plotlyjs_src: Optional[str] = None) -> str:
+        """Return the graph's HTML, loading plotly.js from ``plotlyjs_src``
+        which is by default the asset written by :func:`write_plotlyjs`
+        next to the HTML"""
+        import plotly.offline
+        if plotlyjs_src is None:
+            plotlyjs_src = get_plotlyjs_filename()
+        return "<html><head><meta charset='utf-8'/>" \
+               "<style>html, body {height: 100%; margin: 0}</style>" \
+               "<script src='" + plotlyjs_src + "'></script></head><body>" \
                + plotly.offline.plot(self.get_figure(), include_plotlyjs=False, output_type='div') + "</body></html>"
 
     def get_figure(self):
+        import plotly.graph_objs as go
         return go.Figure(
             data=[*self.edge_trace, self.node_trace],
             layout=go.Layout(
@@ -150,16 +312,61 @@ class PlotlyAdapter:
     @staticmethod
     def get_line_color(weight: int) -> str:
         if weight == 1:
-            return '#ff0000'
+            return LINE_COLORS[0]
         elif weight == 2:
-            return '#ffbf00'
+            return LINE_COLORS[1]
         elif weight <= 5:
-            return '#80ff00'
+            return LINE_COLORS[2]
         elif weight < 10:
-            return '#00ff40'
+            return LINE_COLORS[3]
         elif weight < 20:
-            return '#00ffff'
+            return LINE_COLORS[4]
         elif weight < 25:
-            return '#0040ff'
+            return LINE_COLORS[5]
         else:
-            return '#8000ff'
+            return LINE_COLORS[6]
+
+
+class JSONAdapter:
+    """Adapter to convert a FriendMap into compact JSON graph data, to be
+    rendered in the browser rather than as a plotly figure
+
+    Nodes are given as parallel lists of names, positions and degrees, and
+    edges as ``[source, target, weight, color]`` lists of node indices and
+    an index into ``lineColors``.
+    """
+
+    def __init__(self, friend_map: FriendMap, layout: str,
+                 positions: Optional[Positions] = None):
+        self.title = friend_map.get_title()
+        self.graph = friend_map.get_graph()
+        with METRICS.time("layout"):
+            self.positions = layouts[layout](self.graph, positions)
+
+    def get_data(self) -> Dict[str, Any]:
+        nodes = list(self.graph)
+        index = {node: i for i, node in enumerate(nodes)}
+        xs = []
+        ys = []
+        for node in nodes:
+            x, y = self.positions[node]
+            xs.append(round(float(x), 5))
+            ys.append(round(float(y), 5))
+        return {
+            "title": self.title,
+            "nodes": nodes,
+            "x": xs,
+            "y": ys,
+            "degree": [len(adjacencies)
+                       for _, adjacencies in self.graph.adjacency()],
+            "edges": [
+                [index[node0], index[node1], weight,
+                 LINE_COLORS.index(PlotlyAdapter.get_line_color(weight))]
+                for node0, node1, weight in self.graph.edges(data="weight")
+            ],
+            "lineColors": LINE_COLORS
+        }
+
+    def write_graph(self, filename: str):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(self.get_data(), f, separators=(",", ":"))
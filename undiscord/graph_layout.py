@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""Network graph layouts that scale to large Discord servers"""
+
+import json
+import os
+import tempfile
+import time
+from logging import getLogger
+from typing import Dict, Hashable, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+# networkx is slow to import, and is not needed to load or save positions
+if TYPE_CHECKING:  # pragma: no cover
+    import networkx as nx
+
+__log__ = getLogger(__name__)
+
+Positions = Dict[Hashable, np.ndarray]
+
+# graphs with more nodes than this are laid out with the scalable layouts
+SCALABLE_LAYOUT_THRESHOLD: int = 500
+
+GRID_LAYOUT_ITERATIONS: int = 50
+# iterations used to refine warm started positions
+WARM_START_ITERATIONS: int = 10
+# seconds after which the grid layout stops iterating
+GRID_LAYOUT_TIME_BUDGET: float = 10.0
+REPULSION_BLOCK_SIZE: int = 4096
+
+
+def get_edge_arrays(graph: "nx.Graph") -> Tuple[list, np.ndarray, np.ndarray,
+                                              np.ndarray]:
+    """Return the graph's nodes, and its edges as arrays of node indices and
+    weights"""
+    nodes = list(graph)
+    index = {node: i for i, node in enumerate(nodes)}
+    src = []
+    dst = []
+    weights = []
+    for node0, node1, weight in graph.edges(data="weight", default=1):
+        src.append(index[node0])
+        dst.append(index[node1])
+        weights.append(weight)
+    return nodes, np.array(src, dtype=np.intp), np.array(dst, dtype=np.intp), \
+        np.array(weights, dtype=np.float64)
+
+
+def load_positions(path: str) -> Optional[Positions]:
+    """Load node positions saved by :func:`save_positions`"""
+    try:
+        with open(path, "r") as f:
+            return {node: np.array(position)
+                    for node, position in json.load(f).items()}
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        __log__.warning("ignoring invalid positions file: {}".format(path))
+        return None
+
+
+def save_positions(path: str, positions: Positions):
+    """Save node positions to warm start later layouts of the graph with"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # each writer has its own temporary file, as concurrent graphs of the
+    # same server save to the same path
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp",
+                                     delete=False) as f:
+        json.dump({str(node): [float(x), float(y)]
+                   for node, (x, y) in positions.items()}, f)
+    os.replace(f.name, path)
+
+
+def get_initial_positions(graph: "nx.Graph", nodes: list, pos: Positions,
+                          random: np.random.RandomState) -> np.ndarray:
+    """Return the previous positions of the nodes within the unit square,
+    placing new nodes at the center of their previously positioned
+    neighbours or at random"""
+    import networkx as nx
+    positions = random.rand(len(nodes), 2)
+    for i, node in enumerate(nodes):
+        if node in pos:
+            positions[i] = (np.asarray(pos[node]) + 1) / 2
+            continue
+        neighbours = [pos[neighbour] for neighbour in
+                      nx.all_neighbors(graph, node) if neighbour in pos]
+        if neighbours:
+            positions[i] = (np.mean(neighbours, axis=0) + 1) / 2 + \
+                (positions[i] - 0.5) * 0.01
+    return positions
+
+
+def rescale(positions: np.ndarray) -> np.ndarray:
+    """Center the positions on the origin within a unit scale, like the
+    networkx layouts"""
+    positions = positions - positions.mean(axis=0)
+    limit = np.abs(positions).max()
+    if limit > 0:
+        positions /= limit
+    return positions
+
+
+def grid_layout(graph: "nx.Graph", pos: Optional[Positions] = None,
+                iterations: int = GRID_LAYOUT_ITERATIONS,
+                time_budget: float = GRID_LAYOUT_TIME_BUDGET,
+                seed: int = 0) -> Positions:
+    """Fruchterman-Reingold force directed layout with grid approximated
+    repulsion
+
+    Nodes are binned into about ``sqrt(n)`` grid cells and are repelled by
+    each cell's center of mass rather than by every other node, making an
+    iteration O(n^1.5) instead of O(n^2). Edge attraction is computed
+    exactly. Iterating stops early once ``time_budget`` seconds have passed.
+
+    If previous positions ``pos`` are given the layout is warm started from
+    them, with a lower temperature and ``WARM_START_ITERATIONS`` iterations,
+    so that the nodes mostly keep their place.
+    """
+    nodes, src, dst, weights = get_edge_arrays(graph)
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: np.zeros(2)}
+
+    stop = time.monotonic() + time_budget
+    random = np.random.RandomState(seed)
+    temperature = 0.1
+    if pos:
+        positions = get_initial_positions(graph, nodes, pos, random)
+        iterations = min(iterations, WARM_START_ITERATIONS)
+        temperature = 0.02
+    else:
+        positions = random.rand(n, 2)
+    k = np.sqrt(1.0 / n)
+    side = max(1, int(round(n ** 0.25)))
+    cells_number = side * side
+    cooling = temperature / (iterations + 1)
+    indices = np.arange(n)
+    for iteration in range(iterations):
+        low = positions.min(axis=0)
+        span = positions.max(axis=0) - low + 1e-9
+        cell_xy = np.minimum(((positions - low) / span * side).astype(np.intp),
+                             side - 1)
+        cells = cell_xy[:, 0] * side + cell_xy[:, 1]
+        mass = np.bincount(cells, minlength=cells_number).astype(np.float64)
+        sums = np.stack(
+            [np.bincount(cells, positions[:, 0], cells_number),
+             np.bincount(cells, positions[:, 1], cells_number)], axis=1)
+        centers = sums / np.maximum(mass, 1)[:, None]
+
+        # repulsion from the center of mass of every other cell, computed in
+        # blocks of nodes to bound the memory used
+        displacement = np.empty_like(positions)
+        for start in range(0, n, REPULSION_BLOCK_SIZE):
+            block = slice(start, start + REPULSION_BLOCK_SIZE)
+            delta = positions[block, None, :] - centers[None, :, :]
+            distance2 = np.maximum((delta ** 2).sum(axis=2), 1e-4 * k * k)
+            strength = mass[None, :] / distance2
+            strength[indices[block] - start, cells[block]] = 0
+            displacement[block] = k * k * \
+                (delta * strength[:, :, None]).sum(axis=1)
+        # and from the center of mass of the rest of a node's own cell
+        own_mass = mass[cells] - 1
+        own_delta = positions - (sums[cells] - positions) / \
+            np.maximum(own_mass, 1)[:, None]
+        own_distance2 = np.maximum((own_delta ** 2).sum(axis=1), 1e-4 * k * k)
+        displacement += k * k * own_delta * (own_mass / own_distance2)[:, None]
+
+        # attraction along the edges
+        delta = positions[src] - positions[dst]
+        distance = np.sqrt((delta ** 2).sum(axis=1))
+        attraction = delta * (distance * weights / k)[:, None]
+        for axis in (0, 1):
+            displacement[:, axis] -= np.bincount(src, attraction[:, axis], n)
+            displacement[:, axis] += np.bincount(dst, attraction[:, axis], n)
+
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 0.01)
+        positions += displacement * (temperature / length)[:, None]
+        temperature -= cooling
+        if time.monotonic() > stop:
+            __log__.warning("stopped grid layout: iterations: {} nodes: {} "
+                            "time budget: {}".format(iteration + 1, n,
+                                                     time_budget))
+            break
+    return dict(zip(nodes, rescale(positions)))
+
+
+def reingold_layout(graph: "nx.Graph",
+                    pos: Optional[Positions] = None) -> Positions:
+    """networkx Fruchterman-Reingold layout, refining the previous positions
+    ``pos`` for ``WARM_START_ITERATIONS`` iterations if they are given"""
+    import networkx as nx
+    if pos:
+        pos = {node: position for node, position in pos.items()
+               if node in graph}
+    if pos:
+        return nx.fruchterman_reingold_layout(graph, k=0.25, pos=pos,
+                                              iterations=WARM_START_ITERATIONS)
+    return nx.fruchterman_reingold_layout(graph, k=0.25)
+
+
+def random_layout(graph: "nx.Graph",
+                  pos: Optional[Positions] = None) -> Positions:
+    import networkx as nx
+    return nx.random_layout(graph)
+
+
+def get_spectral_positions(adjacency) -> np.ndarray:
+    """Return the spectral positions of a connected component's nodes from
+    its symmetric sparse adjacency matrix, within a unit scale"""
+    import scipy.sparse
+    import scipy.sparse.linalg
+
+    n = adjacency.shape[0]
+    if n < 4:
+        # too few nodes for the eigensolver, place them on a circle
+        angles = 2 * np.pi * np.arange(n) / n
+        return np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = scipy.sparse.diags(1 / np.sqrt(np.maximum(degrees, 1e-9)))
+    _, vectors = scipy.sparse.linalg.eigsh(scale * adjacency * scale, k=3,
+                                           which="LA")
+    # the eigenvector of the largest eigenvalue only reflects node degrees
+    return rescale(vectors[:, :2] * scale.diagonal()[:, None])
+
+
+def spectral_layout(graph: "nx.Graph",
+                    pos: Optional[Positions] = None) -> Positions:
+    """Lay out the graph with the eigenvectors of its normalized sparse
+    adjacency matrix, falling back to :func:`grid_layout` without scipy or
+    when the eigensolver does not converge
+
+    Each connected component is laid out separately, as the eigenvectors of
+    a disconnected graph only separate its components, and the components
+    are packed in rows from the largest to the smallest, so that nodes
+    without edges end up on a grid.
+
+    The layout is deterministic, so previous positions ``pos`` are only
+    used by the fallback.
+    """
+    try:
+        import scipy.sparse
+        import scipy.sparse.csgraph
+        import scipy.sparse.linalg
+    except ImportError:  # pragma: no cover
+        return grid_layout(graph, pos)
+
+    nodes, src, dst, weights = get_edge_arrays(graph)
+    n = len(nodes)
+    if n < 4 or not len(src):
+        return grid_layout(graph, pos)
+
+    adjacency = scipy.sparse.coo_matrix((weights, (src, dst)),
+                                        shape=(n, n)).tocsr()
+    adjacency = adjacency + adjacency.T
+    _, labels = scipy.sparse.csgraph.connected_components(adjacency,
+                                                          directed=False)
+    sizes = np.bincount(labels)
+    order = np.argsort(labels, kind="mergesort")
+    components = np.split(order, np.cumsum(sizes)[:-1])
+    components.sort(key=len, reverse=True)
+
+    positions = np.zeros((n, 2))
+    # components are packed into square cells with an area proportional to
+    # their number of nodes
+    width = np.sqrt(n) * 2
+    x = y = row_height = 0.0
+    for component in components:
+        side = np.sqrt(len(component))
+        if x > 0 and x + side > width:
+            x = 0.0
+            y += row_height
+            row_height = 0.0
+        try:
+            if len(component) == 1:
+                component_positions = np.zeros((1, 2))
+            else:
+                component_positions = get_spectral_positions(
+                    adjacency[component][:, component])
+        except scipy.sparse.linalg.ArpackError:
+            __log__.warning("spectral layout did not converge: nodes: "
+                            "{}".format(len(component)))
+            return grid_layout(graph, pos)
+        positions[component] = component_positions * side * 0.4 + \
+            [x + side / 2, -y - side / 2]
+        x += side
+        row_height = max(row_height, side)
+    return dict(zip(nodes, rescale(positions)))
+
+
+def auto_layout(graph: "nx.Graph",
+                pos: Optional[Positions] = None) -> Positions:
+    """Use the networkx Fruchterman-Reingold layout for small graphs and the
+    grid layout for large ones"""
+    if len(graph) > SCALABLE_LAYOUT_THRESHOLD:
+        return grid_layout(graph, pos)
+    return reingold_layout(graph, pos)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent on-disk cache of collected discord messages"""
+
+import json
+import sqlite3
+from logging import getLogger
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from undiscord.message_store import get_message_epoch
+
+__log__ = getLogger(__name__)
+
+Message = Dict[str, Any]
+
+
+class MessageCache:
+    """SQLite store of message records keyed by server and channel id
+
+    Discord message ids are snowflakes, which increase with time, so the
+    newest cached message of a channel is the one with the largest id.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        # the connection is shared between the server's threads
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "server_id TEXT NOT NULL, "
+                "channel_id TEXT NOT NULL, "
+                "message_id INTEGER NOT NULL, "
+                "author_id TEXT NOT NULL, "
+                "author_name TEXT NOT NULL, "
+                "timestamp TEXT NOT NULL, "
+                "epoch REAL NOT NULL, "
+                "mentions TEXT NOT NULL, "
+                "server_name TEXT, "
+                "channel_name TEXT, "
+                "content TEXT, "
+                "PRIMARY KEY (server_id, channel_id, message_id))"
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_messages(self, server_id: str, channel_id: str, limit: int,
+                     full_messages: bool = True) -> List[Message]:
+        """Return the newest cached message records of the channel, ordered
+        newest first like ``Client.logs_from``"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT message_id, author_id, author_name, timestamp, epoch, "
+                "mentions, server_name, channel_name, content FROM messages "
+                "WHERE server_id = ? AND channel_id = ? "
+                "ORDER BY message_id DESC LIMIT ?",
+                (server_id, channel_id, limit)
+            ).fetchall()
+        messages = []
+        for message_id, author_id, author_name, timestamp, epoch, mentions, \
+                server_name, channel_name, content in rows:
+            message_data = {
+                "id": str(message_id),
+                "author": {
+                    "name": author_name,
+                    "id": author_id
+                },
+                "timestamp": timestamp,
+                "mentions": json.loads(mentions)
+            }
+            if full_messages:
+                message_data.update(
+                    {
+                        "server": server_name,
+                        "channel": channel_name,
+                        "content": content,
+                    }
+                )
+            else:
+                message_data["epoch"] = epoch
+            messages.append(message_data)
+        return messages
+
+    def add_messages(self, server_id: str, channel_id: str,
+                     messages: List[Message]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO messages VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (server_id, channel_id, int(message["id"]),
+                     message["author"]["id"], message["author"]["name"],
+                     message["timestamp"], get_message_epoch(message),
+                     json.dumps(message["mentions"]), message.get("server"),
+                     message.get("channel"), message.get("content"))
+                    for message in messages
+                ]
+            )
+        __log__.debug("cached messages: server: %s channel: %s number: %d",
+                      server_id, channel_id, len(messages))
+
+    def get_server_version(self, server_id: str) -> Optional[str]:
+        """Return the id of the newest cached message of the server, which
+        changes whenever new messages of the server are cached"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(message_id) FROM messages WHERE server_id = ?",
+                (server_id,)
+            ).fetchone()
+        return None if row[0] is None else str(row[0])
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""Compact columnar storage of collected discord messages"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generator, List, Tuple
+
+import numpy as np
+import pendulum
+
+EPOCH = datetime(1970, 1, 1)
+
+Channel = Dict[str, Any]
+Message = Dict[str, Any]
+
+
+class AuthorTable:
+    """Intern authors into integer indexes
+
+    Authors are interned by id and name, so a name can occur more than once
+    if it is shared by different ids, or an author was renamed.
+    """
+
+    def __init__(self):
+        self.names = []  # type: List[str]
+        self.ids = []  # type: List[str]
+        self.id_codes = []  # type: List[int]
+        self._indexes = {}  # type: Dict[Tuple[str, str], int]
+        self._id_codes = {}  # type: Dict[str, int]
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, author: Dict[str, str]) -> int:
+        key = (author["id"], author["name"])
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self.names)
+            self.names.append(author["name"])
+            self.ids.append(author["id"])
+            self.id_codes.append(
+                self._id_codes.setdefault(author["id"], len(self._id_codes)))
+        return index
+
+    def get_author(self, index: int) -> Dict[str, str]:
+        return {"name": self.names[index], "id": self.ids[index]}
+
+
+class ChannelStore:
+    """The messages of a channel stored as columns
+
+    Message ``i`` was written by ``authors[i]`` at ``epochs[i]`` and
+    mentions ``mention_authors[mention_indptr[i]:mention_indptr[i + 1]]``,
+    with authors being indexes into the server's :class:`AuthorTable`.
+    """
+
+    __slots__ = ("name", "id", "authors", "epochs", "mention_indptr",
+                 "mention_authors")
+
+    def __init__(self, name: str, channel_id: str, authors: np.ndarray,
+                 epochs: np.ndarray, mention_indptr: np.ndarray,
+                 mention_authors: np.ndarray):
+        self.name = name
+        self.id = channel_id
+        self.authors = authors
+        self.epochs = epochs
+        self.mention_indptr = mention_indptr
+        self.mention_authors = mention_authors
+
+    def __len__(self):
+        return len(self.authors)
+
+    @classmethod
+    def from_channel_data(cls, channel: Channel, authors: AuthorTable):
+        messages = channel["messages"]
+        mentions = [[authors.intern(mention) for mention in message["mentions"]]
+                    for message in messages]
+        mention_indptr = np.zeros(len(messages) + 1, dtype=np.int64)
+        np.cumsum([len(mentioned) for mentioned in mentions],
+                  out=mention_indptr[1:])
+        return cls(
+            channel["name"],
+            channel["id"],
+            np.array([authors.intern(message["author"])
+                      for message in messages], dtype=np.int32),
+            np.array([get_message_epoch(message) for message in messages],
+                     dtype=np.float64),
+            mention_indptr,
+            np.array([author for mentioned in mentions
+                      for author in mentioned], dtype=np.int32)
+        )
+
+    def iter_messages(self, authors: AuthorTable) -> Generator[
+            Message, None, None]:
+        """Yield the stored messages as message records"""
+        for i, (author, epoch) in enumerate(zip(self.authors.tolist(),
+                                                self.epochs.tolist())):
+            mentioned = self.mention_authors[
+                self.mention_indptr[i]:self.mention_indptr[i + 1]]
+            yield {
+                "author": authors.get_author(author),
+                "timestamp": str(EPOCH + timedelta(seconds=epoch)),
+                "epoch": epoch,
+                "mentions": [authors.get_author(mention)
+                             for mention in mentioned.tolist()]
+            }
+
+    def to_channel_data(self, authors: AuthorTable) -> Channel:
+        return {
+            "name": self.name,
+            "id": self.id,
+            "messages": list(self.iter_messages(authors))
+        }
+
+
+class ServerStore:
+    """The channels of a server stored as :class:`ChannelStore` columns
+    sharing one :class:`AuthorTable`"""
+
+    def __init__(self, name: str, server_id: str):
+        self.name = name
+        self.id = server_id
+        self.authors = AuthorTable()
+        self.channels = []  # type: List[ChannelStore]
+
+    @classmethod
+    def from_server_data(cls, server_data: Dict[str, Any]):
+        server_store = cls(server_data["name"], server_data.get("id"))
+        for channel in server_data["channels"]:
+            server_store.add_channel(channel)
+        return server_store
+
+    def add_channel(self, channel: Channel) -> ChannelStore:
+        channel_store = ChannelStore.from_channel_data(channel, self.authors)
+        self.channels.append(channel_store)
+        return channel_store
+
+
+def get_message_epoch(message: Message) -> float:
+    try:
+        return message["epoch"]
+    except KeyError:
+        epoch = message["epoch"] = parse_timestamp(message["timestamp"])
+        return epoch
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """Parse a naive UTC timestamp into epoch seconds
+
+    The ``str(datetime)`` format written by ``scrape_server`` is parsed by
+    slicing, anything else falls back to :func:`pendulum.parse`.
+    """
+    if len(timestamp) in (19, 26) and timestamp[4] == "-" \
+            and timestamp[10] == " " and timestamp[13] == ":":
+        try:
+            timestamp_datetime = datetime(
+                int(timestamp[0:4]), int(timestamp[5:7]),
+                int(timestamp[8:10]), int(timestamp[11:13]),
+                int(timestamp[14:16]), int(timestamp[17:19]),
+                int(timestamp[20:26] or 0)
+            )
+            return (timestamp_datetime - EPOCH).total_seconds()
+        except ValueError:
+            pass
+    return pendulum.parse(timestamp).timestamp()
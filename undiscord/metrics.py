@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""Stage timers and counters exposed in the Prometheus text format"""
+
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Lock, local
+from typing import Callable, Dict, List, Optional, Tuple
+
+__log__ = getLogger(__name__)
+
+STAGE_SECONDS = "undiscord_stage_seconds"
+MESSAGES_SCRAPED = "undiscord_messages_scraped_total"
+CHANNELS_SKIPPED = "undiscord_channels_skipped_total"
+GRAPH_NODES = "undiscord_graph_nodes_total"
+GRAPH_EDGES = "undiscord_graph_edges_total"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Thread safe registry of counters and summaries
+
+    Stages timed with :meth:`time` are observed in the ``STAGE_SECONDS``
+    summary, and are also recorded for the current thread between
+    :meth:`start_timings` and :meth:`stop_timings`, for example to report
+    the stages of a single request.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._descriptions = {}  # type: Dict[str, Tuple[str, str]]
+        self._counters = {}  # type: Dict[Tuple[str, Labels], float]
+        self._summaries = {}  # type: Dict[Tuple[str, Labels], List[float]]
+        self._callbacks = {}  # type: Dict[str, Callable[[], float]]
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._descriptions[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+
+    def add_callback(self, name: str, metric_type: str, help_text: str,
+                     function: Callable[[], float]):
+        """Add a metric whose value is read from the function when the
+        metrics are rendered, for values already counted elsewhere"""
+        self.describe(name, metric_type, help_text)
+        with self._lock:
+            self._callbacks[name] = function
+
+    def get_value(self, name: str, **labels: str) -> Optional[float]:
+        """Return the value of a counter or the sum of a summary"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._summaries:
+                return self._summaries[key][1]
+            return self._counters.get(key)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, duration: float):
+        """Record the seconds a stage took"""
+        self.observe(STAGE_SECONDS, duration, stage=stage)
+        timings = getattr(self._local, "timings", None)
+        if timings is not None:
+            timings.append((stage, duration))
+
+    def start_timings(self):
+        self._local.timings = []
+
+    def stop_timings(self) -> List[Tuple[str, float]]:
+        timings = getattr(self._local, "timings", None) or []
+        self._local.timings = None
+        return timings
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            samples = {}  # type: Dict[str, List[str]]
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.setdefault(name, []).append(
+                    format_sample(name, labels, value))
+            for (name, labels), (count, total) in \
+                    sorted(self._summaries.items()):
+                samples.setdefault(name, []).extend([
+                    format_sample(name + "_count", labels, count),
+                    format_sample(name + "_sum", labels, total),
+                ])
+            callbacks = list(self._callbacks.items())
+        for name, function in callbacks:
+            try:
+                samples[name] = [format_sample(name, (), function())]
+            except Exception:  # pylint: disable=broad-except
+                __log__.exception("failed to read metric: {}".format(name))
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text = self._descriptions.get(
+                name, ("untyped", ""))
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+
+def format_sample(name: str, labels: Labels, value: float) -> str:
+    if not labels:
+        return "{} {}".format(name, float(value))
+    return "{}{{{}}} {}".format(
+        name,
+        ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\")
+                                  .replace('"', '\\"').replace("\n", "\\n"))
+                 for key, label in labels),
+        float(value)
+    )
+
+
+METRICS: Metrics = Metrics()
+METRICS.describe(STAGE_SECONDS, "summary",
+                 "Seconds spent in each stage of collecting messages and "
+                 "generating graphs")
+METRICS.describe(MESSAGES_SCRAPED, "counter",
+                 "Discord messages fetched from Discord")
+METRICS.describe(CHANNELS_SKIPPED, "counter",
+                 "Discord channels skipped because of an error")
+METRICS.describe(GRAPH_NODES, "counter", "Nodes of the generated graphs")
+METRICS.describe(GRAPH_EDGES, "counter", "Edges of the generated graphs")
@@ -3,10 +3,20 @@
 """Determine whether a consecutive discord message is a reply to the message
 before it"""
 
+import multiprocessing
+import os
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, Future
+from itertools import chain, takewhile
 from logging import getLogger
-from typing import List, Dict, Any, Generator
+from threading import Lock
+from typing import List, Dict, Any, Generator, Tuple, NamedTuple, Optional, \
+    Deque, Iterable
 
-import pendulum
+import numpy as np
+
+from undiscord.message_store import AuthorTable, ChannelStore, ServerStore, \
+    get_message_epoch
 
 __log__ = getLogger(__name__)
 
@@ -15,13 +25,284 @@ REPLY_TIME = 20
 Channel = Dict[str, Any]
 Message = Dict[str, Any]
 
+# servers with fewer messages are processed in-process, as pickling the
+# channels to worker processes would cost more than it saves
+PARALLEL_MESSAGES_THRESHOLD = 50000
+
+# replies are compared in whole seconds so anything under REPLY_TIME + 1
+REPLY_TIME_MICROSECONDS = (REPLY_TIME + 1) * 10 ** 6
+
+
+class EdgeArrays(NamedTuple):
+    """Aggregated connections between authors
+
+    ``names[src[i]]`` connected to ``names[dst[i]]`` ``count[i]`` times.
+    Authors are interned by id and name, so a name can occur more than once.
+    """
+    names: List[str]
+    src: np.ndarray
+    dst: np.ndarray
+    count: np.ndarray
+
+    def get_counts(self) -> Counter:
+        edge_counts = Counter()
+        for src, dst, count in zip(self.src.tolist(), self.dst.tolist(),
+                                   self.count.tolist()):
+            edge_counts[self.names[src], self.names[dst]] += count
+        return edge_counts
+
 
 def get_connections_from_server(server_data: Message):
+    if isinstance(server_data, ServerStore):
+        names = server_data.authors.names
+        for channel in server_data.channels:
+            sources, replies = get_channel_edges(channel, server_data.authors)
+            for source, reply in zip(sources.tolist(), replies.tolist()):
+                yield names[source], names[reply]
+        return
     for channel in server_data["channels"]:
-        yield from get_possible_connections_from_channel(channel)
+        normalize_channel(channel)
+        yield from get_replies_from_channel(channel)
         yield from get_at_connections(channel)
 
 
+class ProcessPool(Executor):
+    """Pool of at most ``workers`` processes (defaulting to the number of
+    CPUs) that can be shared by the threads of a server
+
+    The processes are started on first use with the forkserver method, or
+    spawn where it is unavailable, as forking a multithreaded process can
+    deadlock the child on locks held by the other threads.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._pool is None:
+                method = "forkserver" if "forkserver" in \
+                    multiprocessing.get_all_start_methods() else "spawn"
+                self._pool = multiprocessing.get_context(method).Pool(
+                    self.workers)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._pool.apply_async(fn, args, kwargs, callback=future.set_result,
+                               error_callback=future.set_exception)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            if wait:
+                pool.join()
+
+
+def get_connection_counts_from_server(
+        server_data: Message, workers: Optional[int] = None,
+        executor: Optional[ProcessPool] = None) -> Counter:
+    """Count the connections of every channel in the server
+
+    Channels are independent, so for large servers they are fanned out to
+    ``workers`` worker processes (defaulting to the number of CPUs) with each
+    worker returning its channel's connection counts. The processes are
+    those of the shared ``executor`` if it is given, otherwise a process
+    pool is created for the call.
+
+    The channels can also be streamed from an iterator, which is consumed
+    one channel at a time. As a stream cannot be sized up front its channels
+    are counted in-process until they add up to
+    :data:`PARALLEL_MESSAGES_THRESHOLD` messages, and only the rest of the
+    stream is fanned out.
+    """
+    if isinstance(server_data, ServerStore):
+        return get_edge_arrays_from_server(server_data).get_counts()
+    channels = server_data["channels"]
+    if workers is None:
+        workers = executor.workers if executor is not None else \
+            os.cpu_count() or 1
+    connection_counts = Counter()
+    if isinstance(channels, list):
+        workers = min(workers, len(channels))
+        if sum(len(channel["messages"]) for channel in channels) < \
+                PARALLEL_MESSAGES_THRESHOLD:
+            workers = 1
+    elif workers > 1:
+        channels = iter(channels)
+        messages_number = 0
+        for channel in channels:
+            connection_counts.update(
+                get_connection_counts_from_channel(channel))
+            messages_number += len(channel["messages"])
+            if messages_number >= PARALLEL_MESSAGES_THRESHOLD:
+                break
+        else:
+            return connection_counts
+
+    if workers <= 1:
+        for channel in channels:
+            connection_counts.update(
+                get_connection_counts_from_channel(channel))
+        return connection_counts
+
+    __log__.info("counting channel connections with {} workers".format(
+        workers))
+    if executor is not None:
+        update_connection_counts(connection_counts, executor, channels,
+                                 workers)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            update_connection_counts(connection_counts, executor, channels,
+                                     workers)
+    return connection_counts
+
+
+def update_connection_counts(connection_counts: Counter, executor: Executor,
+                             channels: Iterable[Channel], workers: int):
+    """Count the connections of the channels with the executor's processes"""
+    # bound the channels in flight so that streamed channels are not all
+    # pulled into memory at once
+    pending = deque()  # type: Deque[Future]
+    for channel in channels:
+        pending.append(executor.submit(get_connection_counts_from_channel,
+                                       channel))
+        if len(pending) >= workers * 2:
+            connection_counts.update(pending.popleft().result())
+    for future in pending:
+        connection_counts.update(future.result())
+
+
+def get_connection_counts_from_channel(channel: Channel) -> Counter:
+    normalize_channel(channel)
+    return Counter(chain(get_replies_from_channel(channel),
+                         get_at_connections(channel)))
+
+
+def get_new_connections_from_channel(new_messages: List[Message],
+                                     tail: List[Message]):
+    """Yield the connections started by ``new_messages``, which are newer
+    than every message in the already processed channel ``tail``
+
+    Both lists are ordered newest first, as collected from Discord, so
+    replies spanning the two are found by continuing into the tail.
+    """
+    tail_messages = {id(message) for message in tail}
+    for message, reply_message in get_message_reply_pairs(new_messages + tail):
+        if id(message) not in tail_messages:
+            yield message["author"]["name"], reply_message["author"]["name"]
+    yield from get_at_connections({"messages": new_messages})
+
+
+def get_channel_tail(messages: Iterable[Message]) -> List[Message]:
+    """Return the newest messages, ordered newest first, that a newer
+    message could still be connected to"""
+    messages = iter(messages)
+    newest = next(messages, None)
+    if newest is None:
+        return []
+    return [newest] + list(takewhile(
+        lambda message: is_reply_time(newest, message), messages))
+
+
+def get_edge_arrays_from_server(server_data: Message) -> EdgeArrays:
+    """Vectorized equivalent of :func:`get_connections_from_server`
+
+    Returns the connections aggregated into edge arrays rather than yielding
+    a tuple per connection. Message records are converted to columns one
+    channel at a time.
+    """
+    if isinstance(server_data, ServerStore):
+        authors = server_data.authors
+        channels = server_data.channels  # type: Iterable[ChannelStore]
+    else:
+        authors = AuthorTable()
+        channels = (ChannelStore.from_channel_data(channel, authors)
+                    for channel in server_data["channels"])
+
+    sources = [np.empty(0, dtype=np.int64)]
+    replies = [np.empty(0, dtype=np.int64)]
+    for channel in channels:
+        source, reply = get_channel_edges(channel, authors)
+        sources.append(source)
+        replies.append(reply)
+
+    names_number = max(len(authors), 1)
+    edges, count = np.unique(
+        np.concatenate(sources) * names_number + np.concatenate(replies),
+        return_counts=True
+    )
+    return EdgeArrays(authors.names, edges // names_number,
+                      edges % names_number, count)
+
+
+def get_channel_edges(channel: ChannelStore, authors: AuthorTable) -> Tuple[
+        np.ndarray, np.ndarray]:
+    """Return the ``(author, connected_author)`` index arrays of every reply
+    and mention in the channel"""
+    channel_authors = channel.authors.astype(np.int64)
+    author_ids = np.array(authors.id_codes, dtype=np.int64)[channel_authors]
+    reply_edges = get_reply_edges(channel_authors, author_ids, channel.epochs)
+    if reply_edges is None:
+        messages = [
+            {"author": {"id": author_id}, "epoch": epoch, "index": author}
+            for author, author_id, epoch in zip(channel_authors.tolist(),
+                                                author_ids.tolist(),
+                                                channel.epochs.tolist())
+        ]
+        reply_edges = get_edge_array([
+            (message["index"], reply_message["index"])
+            for message, reply_message in get_message_reply_pairs(messages)
+        ]).T
+    source, reply = reply_edges
+    mention_sources = np.repeat(channel_authors,
+                                np.diff(channel.mention_indptr))
+    return (np.concatenate([source, mention_sources]),
+            np.concatenate([reply, channel.mention_authors.astype(np.int64)]))
+
+
+def get_edge_array(pairs: List[Tuple[int, int]]) -> np.ndarray:
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def get_reply_edges(authors: np.ndarray, author_ids: np.ndarray,
+                    epochs: np.ndarray) -> Optional[
+                        Tuple[np.ndarray, np.ndarray]]:
+    """Vectorized :func:`get_message_reply_pairs` for one channel
+
+    Returns the ``(author, reply_author)`` index arrays of every reply, or
+    ``None`` if the epochs are not sorted and the window bounds cannot be
+    found with a binary search.
+    """
+    messages_number = len(authors)
+    micros = np.round(epochs * 10 ** 6).astype(np.int64)
+    steps = np.diff(micros)
+    if np.all(steps <= 0):
+        micros = -micros
+    elif not np.all(steps >= 0):
+        return None
+
+    positions = np.arange(messages_number)
+    window_ends = np.searchsorted(micros, micros + REPLY_TIME_MICROSECONDS,
+                                  side="left")
+
+    # a message's replies stop at the next message from the same author
+    order = np.argsort(author_ids, kind="stable")
+    same_author = author_ids[order[1:]] == author_ids[order[:-1]]
+    next_same_author = np.full(messages_number, messages_number,
+                               dtype=np.int64)
+    next_same_author[order[:-1][same_author]] = order[1:][same_author]
+
+    counts = np.minimum(window_ends, next_same_author) - positions - 1
+    message_indexes = np.repeat(positions, counts)
+    reply_indexes = message_indexes + 1 + np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    return authors[message_indexes], authors[reply_indexes]
+
+
 def get_at_connections(channel: Channel):
     for message in channel["messages"]:
         if not message['mentions']:
@@ -39,14 +320,61 @@ def get_possible_connections_from_channel(channel: Channel):
             yield message["author"]["name"], reply_message["author"]["name"]
 
 
+def get_replies_from_channel(channel: Channel) -> Generator[
+        Tuple[str, str], None, None]:
+    """Single pass equivalent of :func:`get_possible_connections_from_channel`
+
+    The same ``(author, reply_author)`` pairs are yielded, but ordered by
+    the replying message instead of the original message.
+    """
+    for message, reply_message in get_message_reply_pairs(channel["messages"]):
+        yield message["author"]["name"], reply_message["author"]["name"]
+
+
+def get_message_reply_pairs(messages: List[Message]) -> Generator[
+        Tuple[Message, Message], None, None]:
+    """Walk the messages once, keeping only the messages that could still
+    receive a reply
+
+    A message stops receiving replies at the first message from its own
+    author or outside of :data:`REPLY_TIME`, exactly as in
+    :func:`get_message_replies`. Thus at most one open message per author is
+    kept at any time.
+    """
+    open_messages = []  # type: List[Message]
+    for next_message in messages:
+        still_open = []
+        for message in open_messages:
+            if next_message["author"]["id"] == message["author"]["id"]:
+                continue
+            if not is_reply_time(message, next_message):
+                continue
+            yield message, next_message
+            still_open.append(message)
+        still_open.append(next_message)
+        open_messages = still_open
+
+
 def get_message_replies(message, next_messages: List[Message]) -> Generator[
     Message, None, None]:
     for next_message in next_messages:
         if next_message["author"]["id"] == message["author"]["id"]:
             break
-        if pendulum.parse(next_message["timestamp"]).diff(
-                pendulum.parse(
-                    message["timestamp"])).in_seconds() <= REPLY_TIME:
+        if is_reply_time(message, next_message):
             yield next_message
         else:
             break
+
+
+def is_reply_time(message: Message, next_message: Message) -> bool:
+    # whole seconds are compared, to match pendulum's Duration.in_seconds(),
+    # and rounding drops float error at the REPLY_TIME + 1 boundary
+    delta = get_message_epoch(next_message) - get_message_epoch(message)
+    return round(abs(delta), 6) < REPLY_TIME + 1
+
+
+def normalize_channel(channel: Channel):
+    """Parse the timestamp of every message in the channel once, storing it
+    as epoch seconds under the message's ``"epoch"`` key"""
+    for message in channel["messages"]:
+        get_message_epoch(message)
@@ -10,8 +10,12 @@ from logging import getLogger
 
 from cheroot.wsgi import Server as WSGIServer, PathInfoDispatcher
 
-import undiscord.server.server
-from undiscord.common import add_log_parser, init_logging
+from undiscord.common import add_log_parser, init_logging, \
+    DEFAULT_IDLE_TIMEOUT, LAYOUT_NAMES, DEFAULT_LAYOUT
+from undiscord.server.graph_cache import GraphCache, \
+    DEFAULT_GRAPH_CACHE_TTL, DEFAULT_GRAPH_CACHE_SIZE
+from undiscord.server.jobs import JobQueue, DEFAULT_JOB_WORKERS, \
+    DEFAULT_JOB_QUEUE_DEPTH, DEFAULT_FINISHED_JOB_TTL
 
 __log__ = getLogger(__name__)
 
@@ -30,6 +34,50 @@ def get_parser() -> argparse.ArgumentParser:
                        help="Port of the webserver")
     group.add_argument("-g", "--graph-dir", dest="graph_dir", default="graph",
                        help="Directory to store generated graphs")
+    group.add_argument("--cache-file", dest="cache_file",
+                       help="Path to a SQLite file to cache collected "
+                            "Discord messages in, so that only new messages "
+                            "are collected")
+    group.add_argument("--job-workers", dest="job_workers", type=int,
+                       default=DEFAULT_JOB_WORKERS,
+                       help="Number of /api/jobs jobs to run at once")
+    group.add_argument("--job-queue-depth", dest="job_queue_depth", type=int,
+                       default=DEFAULT_JOB_QUEUE_DEPTH,
+                       help="Number of /api/jobs jobs that can wait to run "
+                            "before new jobs are refused")
+    group.add_argument("--job-result-ttl", dest="job_result_ttl", type=float,
+                       default=DEFAULT_FINISHED_JOB_TTL,
+                       help="Seconds the result of a finished /api/jobs job "
+                            "is kept for")
+    group.add_argument("--connection-workers", dest="connection_workers",
+                       type=int,
+                       help="Number of worker processes, shared by all "
+                            "requests, to count the connections of large "
+                            "servers with, defaults to the number of CPUs")
+    group.add_argument("--graph-cache-ttl", dest="graph_cache_ttl",
+                       type=float, default=DEFAULT_GRAPH_CACHE_TTL,
+                       help="Seconds a generated graph is reused for "
+                            "identical /api/graph requests")
+    group.add_argument("--graph-cache-size", dest="graph_cache_size",
+                       type=int, default=DEFAULT_GRAPH_CACHE_SIZE,
+                       help="Number of generated graphs to keep, older "
+                            "graphs are deleted from the graph directory")
+    group.add_argument("--layout", choices=LAYOUT_NAMES,
+                       default=DEFAULT_LAYOUT,
+                       help="Layout of /api/graph graphs requested without "
+                            "a layout")
+    group.add_argument("--keep-sessions", dest="keep_sessions",
+                       action="store_true",
+                       help="Keep Discord clients logged in between "
+                            "requests with the same token")
+    group.add_argument("--session-idle-timeout", dest="session_idle_timeout",
+                       type=float, default=DEFAULT_IDLE_TIMEOUT,
+                       help="Seconds an unused Discord client is kept "
+                            "logged in for")
+    group.add_argument("--server-timing", dest="server_timing",
+                       action="store_true",
+                       help="Add a Server-Timing header with the time spent "
+                            "in each stage to API responses")
     group.add_argument("--debug", action="store_true",
                        help="Run the server in Flask debug mode")
     add_log_parser(parser)
@@ -42,6 +90,13 @@ def main(argv=sys.argv[1:]) -> int:
     parser = get_parser()
     args = parser.parse_args(argv)
     init_logging(args, "undiscord_server.log")
+    # imported after parsing the arguments, so that --help stays fast
+    import undiscord.server.server
+    from undiscord.message_cache import MessageCache
+    from undiscord.reply_pry import ProcessPool
+    if args.log_message_sample:
+        import undiscord.bot.__main__
+        undiscord.bot.__main__.MESSAGE_LOG_SAMPLE = args.log_message_sample
 
     graph_dir = os.path.abspath(args.graph_dir)
     os.makedirs(graph_dir, exist_ok=True)
@@ -49,6 +104,25 @@ def main(argv=sys.argv[1:]) -> int:
     __log__.info("starting server: host: {} port: {} graph_dir: {}".format(args.host, args.port, graph_dir))
 
     undiscord.server.server.GRAPH_DIR = graph_dir
+    if args.cache_file:
+        undiscord.server.server.MESSAGE_CACHE = MessageCache(args.cache_file)
+    # job results are kept on disk next to the graphs rather than in memory
+    undiscord.server.server.JOB_QUEUE = JobQueue(
+        args.job_workers, args.job_queue_depth,
+        result_dir=os.path.join(graph_dir, "jobs"),
+        finished_job_ttl=args.job_result_ttl
+    )
+    undiscord.server.server.GRAPH_CACHE = GraphCache(args.graph_cache_ttl,
+                                                     args.graph_cache_size)
+    undiscord.server.server.SERVER_TIMING = args.server_timing
+    undiscord.server.server.GRAPH_LAYOUT = args.layout
+    process_pool = undiscord.server.server.PROCESS_POOL = ProcessPool(
+        args.connection_workers)
+    if args.keep_sessions:
+        from undiscord.bot.sessions import ClientManager
+        client_manager = ClientManager(args.session_idle_timeout)
+        client_manager.start()
+        undiscord.server.server.CLIENT_MANAGER = client_manager
 
     if args.debug:
         undiscord.server.server.APP.run(
@@ -68,6 +142,12 @@ def main(argv=sys.argv[1:]) -> int:
         except Exception:
             __log__.exception("stopping server: unexpected exception")
             raise
+        finally:
+            process_pool.shutdown()
+            if args.keep_sessions:
+                __log__.info("stopping client sessions: {}".format(
+                    client_manager.get_metrics()))
+                client_manager.stop()
 
 
 if __name__ == "__main__":
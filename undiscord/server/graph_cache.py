@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Cache of generated graph files for the flask/cheroot server"""
+
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+__log__ = getLogger(__name__)
+
+DEFAULT_GRAPH_CACHE_TTL: float = 600.0
+DEFAULT_GRAPH_CACHE_SIZE: int = 64
+
+
+class GraphCache:
+    """LRU cache of generated graph files with a time to live
+
+    Each entry maps a key to a graph file and its URL. Graph files are
+    deleted when their entry expires or is evicted, so that at most
+    ``max_size`` graphs, and at least the newest one, are kept on disk.
+    Graphs put as not ``reusable`` are never returned by :meth:`get`, but
+    are kept and deleted like the others so that their files are bounded
+    too.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_GRAPH_CACHE_TTL,
+                 max_size: int = DEFAULT_GRAPH_CACHE_SIZE,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = Lock()
+        self._entries = OrderedDict()  # type: Dict[Hashable, Tuple[float, str, str, bool]]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """Return the URL of the cached graph, if it is still fresh"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, path, url, reusable = entry
+            if self.clock() - created > self.ttl or not os.path.exists(path):
+                self._remove(key)
+                return None
+            if not reusable or self.max_size <= 0:
+                return None
+            self._entries.move_to_end(key)
+        __log__.info("graph cache hit: url: {}".format(url))
+        return url
+
+    def put(self, key: Hashable, path: str, url: str, reusable: bool = True):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock(), path, url, reusable)
+            while len(self._entries) > max(self.max_size, 1):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable):
+        _, path, url, _ = self._entries.pop(key)
+        __log__.info("removing cached graph: url: {}".format(url))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Bounded background job queue for the flask/cheroot server"""
+
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+from uuid import uuid4
+
+__log__ = getLogger(__name__)
+
+DEFAULT_JOB_WORKERS: int = 2
+DEFAULT_JOB_QUEUE_DEPTH: int = 16
+DEFAULT_FINISHED_JOBS: int = 256
+# seconds finished jobs and their results are kept for
+DEFAULT_FINISHED_JOB_TTL: float = 3600.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted to a full :class:`JobQueue`"""
+
+
+class Job:
+    """A unit of work run by a :class:`JobQueue`"""
+
+    def __init__(self, kind: str):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.status = QUEUED
+        self.result = None
+        # path of the JSON result file, if the result is kept on disk
+        self.result_path = None  # type: Optional[str]
+        self.error = None  # type: Optional[str]
+        self.created = time.time()
+        self.started = None  # type: Optional[float]
+        self.finished = None  # type: Optional[float]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "jobId": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """Run jobs on a bounded pool of worker threads
+
+    At most ``workers`` jobs run at once with up to ``queue_depth`` more
+    waiting, beyond which submitting raises :class:`JobQueueFull`. The
+    newest ``finished_jobs`` finished jobs are kept for their results, for
+    at most ``finished_job_ttl`` seconds.
+
+    If a ``result_dir`` is given job results are written there as JSON
+    rather than being held in memory, and are deleted with their job.
+    """
+
+    def __init__(self, workers: int = DEFAULT_JOB_WORKERS,
+                 queue_depth: int = DEFAULT_JOB_QUEUE_DEPTH,
+                 finished_jobs: int = DEFAULT_FINISHED_JOBS,
+                 result_dir: Optional[str] = None,
+                 finished_job_ttl: float = DEFAULT_FINISHED_JOB_TTL):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.finished_jobs = finished_jobs
+        self.result_dir = result_dir
+        self.finished_job_ttl = finished_job_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = Lock()
+        self._jobs = OrderedDict()  # type: Dict[str, Job]
+        self._pending = 0
+
+    def submit(self, kind: str, function: Callable, *args, **kwargs) -> Job:
+        job = Job(kind)
+        with self._lock:
+            if self._pending >= self.workers + self.queue_depth:
+                raise JobQueueFull(
+                    "job queue is full: {} jobs pending".format(self._pending))
+            self._pending += 1
+            self._jobs[job.id] = job
+            self._evict_finished()
+        __log__.info("queued job: id: {} kind: {}".format(job.id, kind))
+        self._executor.submit(self._run, job, function, *args, **kwargs)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._evict_finished()
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, function: Callable, *args, **kwargs):
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            result = function(*args, **kwargs)
+            if self.result_dir is None:
+                job.result = result
+            else:
+                job.result_path = self._write_result(job, result)
+            job.status = DONE
+        except Exception as e:  # pylint: disable=broad-except
+            __log__.exception("failed job: id: {} kind: {}".format(
+                job.id, job.kind))
+            job.error = str(e)
+            job.status = FAILED
+        job.finished = time.time()
+        __log__.info("finished job: id: {} kind: {} status: {} time: {}".format(
+            job.id, job.kind, job.status, job.finished - job.started))
+        with self._lock:
+            self._pending -= 1
+            self._evict_finished()
+
+    def _write_result(self, job: Job, result: Any) -> str:
+        os.makedirs(self.result_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=self.result_dir,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(result, f, separators=(",", ":"))
+        path = os.path.join(self.result_dir, "{}.json".format(job.id))
+        os.replace(f.name, path)
+        return path
+
+    def _evict_finished(self):
+        # jobs that have just set their status are yet to set their finish
+        # time, so they are the newest
+        finished = sorted(
+            (job for job in self._jobs.values()
+             if job.status in (DONE, FAILED)),
+            key=lambda job: float("inf") if job.finished is None
+            else job.finished
+        )
+        expired = time.time() - self.finished_job_ttl
+        for i, job in enumerate(finished):
+            if i < len(finished) - self.finished_jobs or \
+                    job.finished is not None and job.finished < expired:
+                del self._jobs[job.id]
+                if job.result_path is not None:
+                    try:
+                        os.remove(job.result_path)
+                    except FileNotFoundError:
+                        pass
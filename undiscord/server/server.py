@@ -2,17 +2,36 @@
 
 """flask/cheroot server definition"""
 
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import Future
 from logging import getLogger
+from threading import Lock
+from typing import Callable, Dict, Hashable, Iterator, Optional, Tuple, \
+    TYPE_CHECKING
 from uuid import uuid4
 
-from flask import Flask, render_template, send_from_directory
-from flask_restplus import Resource, Api, reqparse, fields
+from flask import Flask, Response, render_template, request, \
+    send_from_directory, stream_with_context, url_for
+from flask_restplus import Resource, Api, reqparse, fields, inputs
 
-from undiscord.bot.__main__ import scrape_server, DEFAULT_MESSAGES_NUMBER, \
-    DEFAULT_TIMEOUT
-from undiscord.friend_map import FriendMap, PlotlyAdapter
-from undiscord.reply_pry import get_connections_from_server
+from undiscord.common import DEFAULT_MESSAGES_NUMBER, DEFAULT_TIMEOUT, \
+    DEFAULT_CONCURRENCY, LAYOUT_NAMES, DEFAULT_LAYOUT, MAX_CONCURRENCY, \
+    concurrency_number, get_token_scope
+from undiscord.message_cache import MessageCache
+from undiscord.metrics import METRICS, GRAPH_NODES, GRAPH_EDGES
+from undiscord.server.graph_cache import GraphCache
+from undiscord.server.jobs import JobQueue, JobQueueFull, Job, QUEUED, \
+    RUNNING, DONE, FAILED
+from undiscord.reply_pry import get_connections_from_server, \
+    get_connection_counts_from_server, ProcessPool
+
+# discord.py and the graph rendering dependencies are slow to import, so
+# they are only imported by the requests that scrape or render graphs
+if TYPE_CHECKING:  # pragma: no cover
+    from undiscord.bot.sessions import ClientManager
 
 __log__ = getLogger(__name__)
 
@@ -20,6 +39,124 @@ APP = Flask(__name__)
 
 GRAPH_DIR: str = "graph"
 
+# seconds browsers may cache the versioned graph assets for
+ASSET_CACHE_TIMEOUT: int = 365 * 24 * 60 * 60
+
+MESSAGE_CACHE: Optional[MessageCache] = None
+
+JOB_QUEUE: JobQueue = JobQueue()
+
+GRAPH_CACHE: GraphCache = GraphCache()
+
+# seconds the node positions of a server's last graph are kept to warm
+# start its next graph with
+POSITIONS_TTL: float = 7 * 24 * 60 * 60
+
+# ids of the servers scraped by (token scope, server name), as servers of
+# different scopes can share a name
+SERVER_IDS = {}  # type: Dict[Tuple[str, str], str]
+
+# layout of graphs requested without one, set by the --layout option
+GRAPH_LAYOUT: str = DEFAULT_LAYOUT
+
+CLIENT_MANAGER = None  # type: Optional[ClientManager]
+
+# worker processes shared by every request to count the connections of
+# large servers with, rather than a process pool forked per request
+PROCESS_POOL: ProcessPool = ProcessPool()
+
+# whether to add a Server-Timing header of the stages of API requests
+SERVER_TIMING: bool = False
+
+
+class SingleFlight:
+    """Share the result of a call with every concurrent call of the same key
+
+    The first caller of a key runs the function while later callers wait on
+    its result, until the call finishes and the key can be called again.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = Lock()
+        self._futures = {}  # type: Dict[Hashable, Future]
+
+    def do(self, key: Hashable, function: Callable, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                self.calls += 1
+                future = self._futures[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            __log__.info("coalesced call: {}".format(
+                getattr(function, "__name__", function)))
+            return future.result()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._futures[key]
+        return future.result()
+
+
+SCRAPES: SingleFlight = SingleFlight()
+
+
+def get_client_metric(name: str) -> int:
+    if CLIENT_MANAGER is None:
+        return 0
+    return CLIENT_MANAGER.get_metrics()[name]
+
+
+METRICS.add_callback("undiscord_scrapes_total", "counter",
+                     "Scrapes run, excluding those coalesced into another",
+                     lambda: SCRAPES.calls)
+METRICS.add_callback("undiscord_scrapes_coalesced_total", "counter",
+                     "Scrapes that waited on an identical scrape in flight",
+                     lambda: SCRAPES.coalesced)
+METRICS.add_callback("undiscord_graph_cache_size", "gauge",
+                     "Cached generated graphs", lambda: len(GRAPH_CACHE))
+METRICS.add_callback("undiscord_client_sessions", "gauge",
+                     "Logged in Discord client sessions",
+                     lambda: get_client_metric("sessions"))
+METRICS.add_callback("undiscord_client_logins_total", "counter",
+                     "Discord logins of client sessions",
+                     lambda: get_client_metric("logins"))
+METRICS.add_callback("undiscord_client_logins_avoided_total", "counter",
+                     "Scrapes reusing a logged in client session",
+                     lambda: get_client_metric("logins_avoided"))
+METRICS.add_callback("undiscord_client_evictions_total", "counter",
+                     "Idle client sessions logged out",
+                     lambda: get_client_metric("evictions"))
+
+
+@APP.before_request
+def start_timings():
+    if SERVER_TIMING and request.path.startswith("/api/"):
+        METRICS.start_timings()
+
+
+@APP.after_request
+def add_server_timing(response):
+    if SERVER_TIMING and request.path.startswith("/api/"):
+        timings = METRICS.stop_timings()
+        if timings:
+            response.headers["Server-Timing"] = ", ".join(
+                "{};dur={:.1f}".format(stage, duration * 1000)
+                for stage, duration in timings)
+    return response
+
+
+@APP.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 
 @APP.route('/', methods=["GET"])
 def index():
@@ -32,6 +169,29 @@ def graph(graph_uuid):
     return send_from_directory(GRAPH_DIR, '{}.html'.format(graph_uuid))
 
 
+@APP.route('/graph/<graph_uuid>/data', methods=["GET"])
+def graph_data(graph_uuid):
+    # a graph's data never changes once written
+    return send_from_directory(GRAPH_DIR, '{}.json'.format(graph_uuid),
+                               cache_timeout=ASSET_CACHE_TIMEOUT)
+
+
+@APP.route('/graph/<graph_uuid>/view', methods=["GET"])
+def graph_view(graph_uuid):
+    from undiscord.friend_map import get_plotlyjs_filename
+    return render_template(
+        'graph.html',
+        data_url=url_for('graph_data', graph_uuid=graph_uuid),
+        plotlyjs_src=url_for('graph_asset', filename=get_plotlyjs_filename())
+    )
+
+
+@APP.route('/graph/assets/<filename>', methods=["GET"])
+def graph_asset(filename):
+    return send_from_directory(os.path.join(GRAPH_DIR, "assets"), filename,
+                               cache_timeout=ASSET_CACHE_TIMEOUT)
+
+
 API = Api(
     APP,
     version='1.0',
@@ -52,54 +212,362 @@ connections_parser.add_argument('timeout', type=float,
                                 default=DEFAULT_TIMEOUT,
                                 help="Time to collect Discord messages before "
                                      "stopping")
+connections_parser.add_argument('concurrency', type=concurrency_number,
+                                default=DEFAULT_CONCURRENCY,
+                                help="Number of Discord channels to collect "
+                                     "messages from at once, at most {}"
+                                .format(MAX_CONCURRENCY))
+connections_parser.add_argument('channel_timeout', type=float,
+                                help="Time to collect a Discord channel's "
+                                     "messages before truncating it")
+
+# connections written per chunk of a streamed response
+STREAM_CHUNK_SIZE: int = 1000
+
+stream_parser = connections_parser.copy()
+stream_parser.add_argument('aggregate', type=inputs.boolean, default=False,
+                           help="Whether to return each distinct connection "
+                                "once with its count, rather than every "
+                                "connection")
+stream_parser.add_argument('stream', type=str, choices=["json", "ndjson"],
+                           help="Stream the connections as they are found, "
+                                "as a chunked JSON array or as newline "
+                                "delimited JSON")
+
+graph_parser = connections_parser.copy()
+graph_parser.add_argument('layout', type=str, choices=LAYOUT_NAMES,
+                          help="Layout to position the graph's nodes with, "
+                               "defaults to the server's --layout")
+graph_parser.add_argument('format', type=str, choices=["html", "json"],
+                          default="html",
+                          help="Whether to render the graph as HTML on the "
+                               "server, or as JSON data rendered in the "
+                               "browser")
 
 connections_model = API.schema_model('Connections', {
     "type": "array",
+    "description": "[src, dst] pairs of author names, or [src, dst, count] "
+                   "triples with the connection's count if aggregate",
     "items": {
         "type": "array",
         "minItems": 2,
-        "maxItems": 2,
+        "maxItems": 3,
         "items": {
-            "type": "string"
+            "description": "author name, or the count of an aggregated "
+                           "connection"
         }
     }
 })
 
 
+def scrape_server(**kwargs) -> dict:
+    from undiscord.bot.__main__ import scrape_server as bot_scrape_server
+    return bot_scrape_server(**kwargs)
+
+
+def scrape(args) -> dict:
+    """Scrape the server, sharing the scrape with concurrent requests for
+    the same server, token scope and scrape parameters
+
+    Each request gets its own copy of the shared scrape, as the analysis
+    adds to the message records.
+    """
+    return copy_server_data(SCRAPES.do(
+        (get_token_scope(args['token']), args['server_name'],
+         args['messages_number'], args['timeout'], args['concurrency'],
+         args['channel_timeout']),
+        scrape_server if CLIENT_MANAGER is None
+        else CLIENT_MANAGER.scrape_server,
+        token=args['token'],
+        server_name=args['server_name'],
+        messages_number=args['messages_number'],
+        timeout=args["timeout"],
+        concurrency=args["concurrency"],
+        cache=MESSAGE_CACHE,
+        channel_timeout=args["channel_timeout"]
+    ))
+
+
+def copy_server_data(server_data: dict) -> dict:
+    """Copy the server data down to its message records, which share their
+    unchanged author and mentions"""
+    server_data = dict(server_data)
+    if "channels" in server_data:
+        server_data["channels"] = [
+            dict(channel, messages=[dict(message)
+                                    for message in channel["messages"]])
+            for channel in server_data["channels"]
+        ]
+    return server_data
+
+
+def get_connections(args) -> list:
+    server_data = scrape(args)
+    with METRICS.time("reply_pry"):
+        return list(get_connections_from_server(server_data))
+
+
+def iter_connections(server_data, aggregate: bool = False) -> Iterator[list]:
+    """Yield the server's connections, or each distinct connection once
+    with its count if ``aggregate``"""
+    if aggregate:
+        with METRICS.time("reply_pry"):
+            connection_counts = get_connection_counts_from_server(
+                server_data, executor=PROCESS_POOL)
+        for (src, dst), count in connection_counts.items():
+            yield [src, dst, count]
+    else:
+        # only the time spent finding connections is recorded, not the time
+        # the consumer takes between them
+        connections = get_connections_from_server(server_data)
+        duration = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                connection = next(connections, None)
+                duration += time.perf_counter() - start
+                if connection is None:
+                    break
+                yield list(connection)
+        finally:
+            METRICS.record("reply_pry", duration)
+
+
+def iter_chunks(connections: Iterator[list], stream: str) -> Iterator[str]:
+    """Encode the connections as a JSON array or as newline delimited
+    JSON, in chunks of ``STREAM_CHUNK_SIZE`` connections"""
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    if stream == "ndjson":
+        start, separator, end = "", "\n", "\n"
+    else:
+        start, separator, end = "[", ",", "]"
+    chunk = []
+    for connection in connections:
+        chunk.append(encoder.encode(connection))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield start + separator.join(chunk)
+            # later chunks continue the previous one
+            start = separator
+            chunk = []
+    if chunk:
+        yield start + separator.join(chunk) + end
+    elif start in ("", "["):
+        # no connections were written
+        yield "[]" if stream == "json" else ""
+    else:
+        yield end
+
+
+def get_graph_url(args) -> dict:
+    from undiscord.friend_map import FriendMap, PlotlyAdapter, JSONAdapter, \
+        write_plotlyjs, get_plotlyjs_filename
+    from undiscord.graph_layout import load_positions, save_positions
+    layout = args.get('layout') or GRAPH_LAYOUT
+    graph_format = args.get('format') or "html"
+    graph_url = GRAPH_CACHE.get(get_graph_key(args, layout, graph_format))
+    if graph_url is not None:
+        return get_graph_urls(graph_url, graph_format)
+
+    server_data = scrape(args)
+    if "id" in server_data:
+        SERVER_IDS[(get_token_scope(args['token']), args['server_name'])] = \
+            server_data["id"]
+    with METRICS.time("friend_map"):
+        friend_map = FriendMap(server_data, executor=PROCESS_POOL)
+    METRICS.inc(GRAPH_NODES, friend_map.get_graph().number_of_nodes())
+    METRICS.inc(GRAPH_EDGES, friend_map.get_graph().number_of_edges())
+    positions_path = get_positions_path(args, server_data.get("id"), layout)
+    positions = load_positions(positions_path)
+    uuid = uuid4()
+    os.makedirs(GRAPH_DIR, exist_ok=True)
+    # graphs share one plotly.js asset rather than each embedding it
+    write_plotlyjs(os.path.join(GRAPH_DIR, "assets"))
+    if graph_format == "json":
+        json_graph = JSONAdapter(friend_map, layout, positions)
+        positions = json_graph.positions
+        graph_path = os.path.join(GRAPH_DIR, "{}.json".format(uuid))
+        with METRICS.time("plot"):
+            json_graph.write_graph(graph_path)
+        graph_url = "/graph/{}/view".format(uuid)
+    else:
+        html_graph = PlotlyAdapter(friend_map, layout, positions)
+        positions = html_graph.positions
+        graph_path = os.path.join(GRAPH_DIR, "{}.html".format(uuid))
+        with METRICS.time("plot"):
+            html_graph.plot_graph(graph_path,
+                                  "assets/{}".format(get_plotlyjs_filename()))
+        graph_url = "/graph/{}".format(uuid)
+    save_positions(positions_path, positions)
+    remove_expired_positions()
+    if server_data.get("truncated_channels"):
+        # a truncated graph is not served to later requests, which may allow
+        # the scrape more time, but is still deleted when evicted
+        GRAPH_CACHE.put(graph_path, graph_path, graph_url, reusable=False)
+    else:
+        # the scrape may have cached new messages and changed the data version
+        GRAPH_CACHE.put(get_graph_key(args, layout, graph_format), graph_path,
+                        graph_url)
+    return get_graph_urls(graph_url, graph_format)
+
+
+def get_graph_urls(graph_url: str, graph_format: str) -> dict:
+    if graph_format == "json":
+        return {
+            "graphURL": graph_url,
+            "dataURL": "{}/data".format(graph_url.rsplit("/", 1)[0])
+        }
+    return {"graphURL": graph_url}
+
+
+def get_positions_path(args, server_id: Optional[str], layout: str) -> str:
+    """Return the path of the server's last node positions of the layout,
+    which warm start its next graph"""
+    digest = hashlib.sha256("{}\n{}\n{}\n{}".format(
+        get_token_scope(args['token']), server_id, args['server_name'],
+        layout).encode("utf-8")).hexdigest()
+    return os.path.join(GRAPH_DIR, "positions", "{}.json".format(digest))
+
+
+def remove_expired_positions():
+    """Delete the node positions not updated for ``POSITIONS_TTL`` seconds"""
+    positions_dir = os.path.join(GRAPH_DIR, "positions")
+    expired = time.time() - POSITIONS_TTL
+    for filename in os.listdir(positions_dir):
+        path = os.path.join(positions_dir, filename)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_graph_key(args, layout: str, graph_format: str) -> tuple:
+    token_scope = get_token_scope(args['token'])
+    server_id = SERVER_IDS.get((token_scope, args['server_name']))
+    data_version = None
+    if MESSAGE_CACHE is not None and server_id is not None:
+        data_version = MESSAGE_CACHE.get_server_version(server_id)
+    return (token_scope, args['server_name'], server_id,
+            args['messages_number'], layout, graph_format, data_version)
+
+
 @API.route('/api/connections')
-@API.expect(connections_parser)
+@API.expect(stream_parser)
 class GetConnections(Resource):
-    @API.marshal_with(connections_model, code=201, description='Object created')
+    @API.response(201, 'Object created', connections_model)
     def post(self):
-        args = connections_parser.parse_args()
-        server_data = scrape_server(
-            token=args['token'],
-            server_name=args["server_name"],
-            messages_number=args["messages_number"],
-            timeout=args["timeout"]
+        """Return the connections of the server, as ``[src, dst]`` pairs or
+        as aggregated ``[src, dst, count]`` triples
+
+        The connections are first scraped in full, so that scraping errors
+        still set the status code, and then written as they are found when
+        ``stream`` is given rather than being collected into one response.
+        """
+        args = stream_parser.parse_args()
+        if not args["stream"]:
+            if args["aggregate"]:
+                return list(iter_connections(scrape(args), True)), 201
+            return get_connections(args), 201
+        connections = iter_connections(scrape(args), args["aggregate"])
+        return Response(
+            stream_with_context(iter_chunks(connections, args["stream"])),
+            status=201,
+            mimetype="application/x-ndjson" if args["stream"] == "ndjson"
+            else "application/json"
         )
-        connections = list(get_connections_from_server(server_data))
-        return connections, 201
 
 
-graph_url_model = API.model('graphURL', {"graphURL": fields.String})
+graph_url_model = API.model('graphURL', {
+    "graphURL": fields.String,
+    "dataURL": fields.String,
+})
 
 
 @API.route('/api/graph')
-@API.expect(connections_parser)
+@API.expect(graph_parser)
 class GetConnectionsGraph(Resource):
     @API.marshal_with(graph_url_model, code=201, description='Object created')
     def post(self):
-        args = connections_parser.parse_args()
-        server_data = scrape_server(
-            token=args['token'],
-            server_name=args['server_name'],
-            messages_number=args['messages_number'],
-            timeout=args["timeout"]
-        )
-        friend_map = FriendMap(server_data)
-        html_graph = PlotlyAdapter(friend_map, "reingold")
-        uuid = uuid4()
-        os.makedirs(GRAPH_DIR, exist_ok=True)
-        html_graph.plot_graph(os.path.join(GRAPH_DIR, "{}.html".format(uuid)))
-        return {"graphURL": "/graph/{}".format(uuid)}, 201
+        args = graph_parser.parse_args()
+        return get_graph_url(args), 201
+
+
+job_model = API.model('Job', {
+    "jobId": fields.String,
+    "kind": fields.String,
+    "status": fields.String(enum=[QUEUED, RUNNING, DONE, FAILED]),
+    "error": fields.String,
+    "created": fields.Float,
+    "started": fields.Float,
+    "finished": fields.Float,
+    "statusURL": fields.String,
+    "resultURL": fields.String,
+})
+
+
+def get_job_data(job: Job) -> dict:
+    job_data = job.to_dict()
+    job_data.update(
+        {
+            "statusURL": "/api/jobs/{}".format(job.id),
+            "resultURL": "/api/jobs/{}/result".format(job.id),
+        }
+    )
+    return job_data
+
+
+def submit_job(kind: str, function, parser: reqparse.RequestParser) -> dict:
+    args = parser.parse_args()
+    try:
+        job = JOB_QUEUE.submit(kind, function, args)
+    except JobQueueFull as e:
+        API.abort(503, str(e))
+    return get_job_data(job)
+
+
+@API.route('/api/jobs/connections')
+@API.expect(connections_parser)
+class PostConnectionsJob(Resource):
+    @API.marshal_with(job_model, code=202, description='Job queued')
+    def post(self):
+        return submit_job("connections", get_connections,
+                          connections_parser), 202
+
+
+@API.route('/api/jobs/graph')
+@API.expect(graph_parser)
+class PostConnectionsGraphJob(Resource):
+    @API.marshal_with(job_model, code=202, description='Job queued')
+    def post(self):
+        return submit_job("graph", get_graph_url, graph_parser), 202
+
+
+def get_job(job_id: str) -> Job:
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        API.abort(404, "job not found: {}".format(job_id))
+    return job
+
+
+@API.route('/api/jobs/<string:job_id>')
+class GetJob(Resource):
+    @API.marshal_with(job_model, description='Job status')
+    def get(self, job_id):
+        return get_job_data(get_job(job_id))
+
+
+@API.route('/api/jobs/<string:job_id>/result')
+class GetJobResult(Resource):
+    @API.response(409, 'Job not finished')
+    @API.response(500, 'Job failed')
+    def get(self, job_id):
+        job = get_job(job_id)
+        if job.status == FAILED:
+            API.abort(500, "job failed: {}".format(job.error))
+        if job.status != DONE:
+            API.abort(409, "job is {}".format(job.status))
+        if job.result_path is not None:
+            return send_from_directory(os.path.dirname(job.result_path),
+                                       os.path.basename(job.result_path),
+                                       mimetype="application/json")
+        return job.result